@@ -6,8 +6,8 @@
 print('Importing modules...')
 
 ## core utilities
+import sys
 import os
-import json
 
 ## other utilities
 from colorit import *  # colourful printing
@@ -16,6 +16,9 @@ init_colorit() # enable printing with colour
 ## archivist.py
 import archivist
 
+## registry.py
+import registry
+
 # list of environmental variables used in this script (through functions in archivist.py)
 ## AWS_ID: environmental variable of AWS ID
 ## AWS_KEY: environmental variable of AWS key
@@ -26,16 +29,28 @@ import archivist
 ## SMTP_PORT: environmental variable of email server port
 ## CHROME_BIN: path to Chromium/Chrome binary
 ## CHROMEDRIVER_BIN: path to Chromedriver
+## DL_WORKERS: optional, maximum number of downloads to run at once (default: 1, i.e., serial)
+## DL_HOST_WORKERS: optional, maximum number of downloads to run at once from a single host (default: 2)
+## DL_HOST_RATE: optional, maximum number of downloads started per second from a single host (default: 1)
+## DL_RETRIES: optional, maximum number of retries of a download after a transient failure, e.g., a timeout or HTTP 503 (default: 2)
+## DL_BROWSER_WORKERS: optional, number of downloads with a headless browser run at once by their own pool of workers, separate from the DL_WORKERS plain downloads (default: 0, i.e., all downloads share the DL_WORKERS workers)
+## UL_WORKERS: optional, number of threads uploading files in the background while the next files are downloaded (default: 2, 0 to upload each file before the next download)
+## DEDUP: optional, if "True", files identical to the last archived version are not uploaded again (default: "False")
+## DL_EVENTS: optional, path of a file to which the timing and metrics of each download are appended as JSON lines (default: not written)
+## CONDITIONAL_GET: optional, if "True", files not modified since the last archived version (HTTP 304) are not downloaded again (default: "False")
+## SHARD_ISOLATE_BROWSER: optional, if "True", in a sharded run (--shard), shard 1 gets all datasets downloaded with a headless browser and the other shards split the rest (default: "False")
+## LOG_STORAGE: optional, "segments" to upload the log entry of each run as its own object or "file" to append it to log.txt (default: "segments", see logs.py)
 
 # set mode from argv (prod versus test)
 ## prod: Download files and upload them to the server.
 ## test: Don't upload files to the server, just test that they can be successfully downloaded.
+## optional: --shard i/n --run <id> (e.g., prod --shard 2/4 --run 2020-11-04): only run shard i of n of the active datasets; in prod mode, the results are uploaded to be merged
+## optional: --merge n --run <id> (prod only, e.g., prod --merge 4 --run 2020-11-04): merge the results of the n shards of the sharded run, then upload and email the log
+## the run id (letters, digits and hyphens) must be the same for every shard of a run and its merge (only required in prod mode)
 archivist.set_mode()
 
-# initialize global variables
-archivist.success = 0 # success counter
-archivist.failure = 0 # failure counter
-archivist.download_log = '' # download log
+# initialize results of the run (successes, failures and unchanged files)
+archivist.ledger = archivist.RunLedger()
 
 # load AWS credentials
 archivist.aws_id = os.environ['AWS_ID']
@@ -48,6 +63,16 @@ mail_to = os.environ['MAIL_TO']
 smtp_server = os.environ['SMTP_SERVER']
 smtp_port = int(os.environ['SMTP_PORT'])
 
+# load download concurrency configuration
+dl_workers = int(os.environ.get('DL_WORKERS', 1))
+dl_host_workers = int(os.environ.get('DL_HOST_WORKERS', 2))
+dl_host_rate = float(os.environ.get('DL_HOST_RATE', 1))
+dl_retries = int(os.environ.get('DL_RETRIES', 2))
+dl_browser_workers = int(os.environ.get('DL_BROWSER_WORKERS', 0))
+ul_workers = int(os.environ.get('UL_WORKERS', 2))
+archivist.pool_maxsize = max(dl_host_workers, 1) # keep a connection alive for each download from a host
+archivist.events_file = os.environ.get('DL_EVENTS')
+
 # access Amazon S3
 if archivist.mode == 'prod':
         ## access S3
@@ -55,20 +80,61 @@ if archivist.mode == 'prod':
         
         ## set S3 path prefix root for achived files
         archivist.prefix_root = 'archive'
+        
+        ## load manifest and HTTP validators of the last archived version of each dataset
+        archivist.manifest = archivist.load_state('manifest.json')
+        archivist.dedup = os.environ.get('DEDUP', 'False') == 'True'
+        archivist.validators = archivist.load_state('validators.json')
+        archivist.conditional_get = os.environ.get('CONDITIONAL_GET', 'False') == 'True'
+        
+        ## load URLs found on landing pages during the last run
+        archivist.url_cache = archivist.load_state('url_cache.json')
+        
+        ## load expected duration of each dataset, so the slowest datasets are started first
+        archivist.dataset_durations = archivist.load_state('durations.json')
+        
+        ## set storage of the full log
+        archivist.log_storage = os.environ.get('LOG_STORAGE', 'segments')
+
+# load active datasets (validated before any download starts)
+try:
+        ds = registry.active(registry.load_registry('datasets.json'))
+except ValueError as e:
+        sys.exit('Error: ' + str(e))
+
+# merge the results of a sharded run (when mode == prod)
+if archivist.merge:
+        
+        ## merge results and state files of the shards (every active dataset must be run by exactly one shard)
+        t, shard_keys, states_uploaded = archivist.merge_shards(archivist.merge, ds)
+        
+        ## summarize successes and failures
+        archivist.print_success_failure()
+        
+        ## upload log, then remove the merged results (kept if an upload failed, so the merge can be run again)
+        log = archivist.output_log(t)
+        if archivist.upload_log(log, t) and states_uploaded:
+                archivist.delete_objects(shard_keys)
+        else:
+                print(background('Results of the shards kept, run the merge again: --merge ' + str(archivist.merge) + ' --run ' + archivist.run_id, Colors.red))
+                archivist.ledger.add({'status': 'Failure', 'file': 'merge of the sharded run (log or state files not uploaded, results of the shards kept)', 'logged': True, 'key': None, 'uuid': None, 'bytes': None, 'durations': {}})
+        
+        ## email log
+        subject, body = archivist.ledger.render_email(t, archivist.mode)
+        archivist.email_log(mail_name, mail_pass, mail_to, subject, body, smtp_server, smtp_port)
+        sys.exit()
 
 # define time script started running in America/Toronto time zone
 t = archivist.get_datetime('America/Toronto')
 
-# load active datasets
-with open('datasets.json') as json_file:
-        datasets = json.load(json_file)
-datasets = datasets['active'] # subset active datasets
-
-# convert datasets into single dictionary
-ds = {} # create empty dictionary
-for d in datasets:
-        for i in range(len(datasets[d])):
-                ds[datasets[d][i]['id_name']] = datasets[d][i]
+# keep the datasets of this shard only (sharded run)
+if archivist.shard:
+        shard_isolate_browser = os.environ.get('SHARD_ISOLATE_BROWSER', 'False') == 'True'
+        ## balance the shards by the expected duration of their datasets, if known
+        ## every shard must load the same durations.json: the split each shard used is checked when the results are merged
+        durations = dict(archivist.dataset_durations) if archivist.dataset_durations else None # copy: updated after the downloads
+        ds = archivist.shard_datasets(ds, archivist.shard[0], archivist.shard[1], durations=durations, isolate_browser=shard_isolate_browser)
+        print('Datasets in this shard: ' + str(len(ds)))
 
 # create dict of download functions
 dl_funs = {
@@ -77,107 +143,69 @@ dl_funs = {
         "ss_page": archivist.ss_page
 }
 
-# define functions to process arguments
+# announce preparation of file downloads
+print('Preparing file downloads...')
 
-## define function to process true/false arguments
-def arg_bool(arg):
-        if ds[key]['args'][arg] == "True":
-                arg_val = True
-        elif ds[key]['args'][arg] == "False":
-                arg_val = False
-        else:
-                print('Error decoding arg ' + arg + ', setting value to False.')
-                arg_val = False
-        return(arg_val)
+# find URLs of datasets without a static URL (all at once, before the downloads start)
+print('Finding dynamic URLs...')
+urls = archivist.resolve_urls(ds, workers=dl_workers)
 
-## define function to process integer arguments
-def arg_int(arg):
-        arg_val = int(ds[key]['args'][arg])
-        return(arg_val)
+# loop through all datasets and assemble list of download jobs
+jobs = []
+for d in ds:
+        
+        ## if URL is not static, use the URL found above
+        url = d.url
+        if url is None:
+                url = urls[d.uuid]
+                ## URL could not be found: log failure and skip download
+                if url is None:
+                        name = d.file_name + '_' + t.strftime('%Y-%m-%d_%H-%M') + '.' + d.file_ext
+                        archivist.log_result(os.path.join(d.dir_parent, d.dir_file, name), 'Failure')
+                        continue
+        
+        ## add download function and its arguments (including uuid and file extension) to list of jobs
+        jobs.append((d.id_name, dl_funs[d.dl_fun], d.kwargs(url)))
 
-# announce beginning file uploads
+# announce beginning file downloads
 print('Beginning file downloads...')
 
-# loop through all datasets
-for key in ds:
-        
-        ## skip if dataset is not active
-        if ds[key]['active'] != "True":
-                print('Skipping inactive dataset...')
-                continue
-        
-        ## print key
-        print(key)
-        
-        ## if URL is not static, get URL
-        if 'url' not in ds[key]:
-                exec(ds[key]['url_fun_python']) # url saved as global var 'url_current'
-                ds[key]['url'] = url_current
-                print(ds[key]['url']) # print result
-        
-        ## get download function for dataset according to 'dl_fun'
-        dl_fun = dl_funs[ds[key]['dl_fun']]
-        
-        ## process file extension
-        if ds[key]['url'] == '':
-                ext = ''
-        else:
-                ext = '.' + ds[key]['file_ext']
-        
-        ## process other arguments
-        
-        ### user (dl_file, html_page, ss_page)
-        if 'user' in ds[key]['args']:
-                ds[key]['args']['user'] = arg_bool('user')
-        ### verify (dl_file)
-        if 'verify' in ds[key]['args']:
-                ds[key]['args']['verify'] = arg_bool('verify')
-        ### unzip (dl_file)
-        if 'unzip' in ds[key]['args']:
-                ds[key]['args']['unzip'] = arg_bool('unzip')
-        ### ab_json_to_csv (dl_file)
-        if 'ab_json_to_csv' in ds[key]['args']:
-                ds[key]['args']['ab_json_to_csv'] = arg_bool('ab_json_to_csv')
-        ### mb_json_to_csv (dl_file)
-        if 'mb_json_to_csv' in ds[key]['args']:
-                ds[key]['args']['mb_json_to_csv'] = arg_bool('mb_json_to_csv')
-        ## js (html_page)
-        if 'js' in ds[key]['args']:
-                ds[key]['args']['js'] = arg_bool('js')
-        ## wait (html_page, ss_page)
-        if 'wait' in ds[key]['args']:
-                ds[key]['args']['wait'] = arg_int('wait')
-        ## width (html_page, ss_page)
-        if 'width' in ds[key]['args']:
-                ds[key]['args']['width'] = arg_int('width')
-        ## height (html_page, ss_page)
-        if 'height' in ds[key]['args']:
-                ds[key]['args']['height'] = arg_int('height')
-        ## run download function
-        dl_fun(
-                url = ds[key]['url'],
-                dir_parent = ds[key]['dir_parent'],
-                dir_file = ds[key]['dir_file'],
-                file = ds[key]['file_name'],
-                ext = ext,
-                **ds[key]['args']
-        )
+# run download jobs (slowest datasets first)
+archivist.run_downloads(jobs, workers=dl_workers, host_workers=dl_host_workers, retries=dl_retries, host_rate=dl_host_rate, upload_workers=ul_workers, browser_workers=dl_browser_workers)
+
+# quit headless browsers
+archivist.quit_webdrivers()
 
 # summarize successes and failures
 archivist.print_success_failure()
 
+# summarize slowest datasets and hosts
+archivist.print_events_summary()
+
+# update expected duration of each dataset
+archivist.update_durations()
+
 # assemble log entry
-log = archivist.output_log(archivist.download_log, t)
+log = archivist.output_log(t)
+
+# upload results of this shard, to be merged with the other shards (when mode == prod)
+if archivist.mode == 'prod' and archivist.shard:
+        archivist.upload_shard(t, {'manifest.json': archivist.manifest, 'validators.json': archivist.validators, 'url_cache.json': archivist.url_cache, 'durations.json': archivist.dataset_durations}, [d.uuid for d in ds], durations)
 
 # upload and email log of file uploads (wehn mode == prod)
-if archivist.mode == 'prod':
+elif archivist.mode == 'prod':
         
         ## upload log
-        archivist.upload_log(log)
+        archivist.upload_log(log, t)
+        
+        ## upload manifest and HTTP validators of the last archived version of each dataset
+        archivist.upload_state(archivist.manifest, 'manifest.json')
+        archivist.upload_state(archivist.validators, 'validators.json')
+        archivist.upload_state(archivist.url_cache, 'url_cache.json')
+        archivist.upload_state(archivist.dataset_durations, 'durations.json')
         
         ## compose email message (current log entry)
-        subject = " ".join(['PROD', 'Covid19CanadaArchive Log', t.strftime('%Y-%m-%d %H:%M') + ',', 'Failed:', str(archivist.failure)])
-        body = log        
+        subject, body = archivist.ledger.render_email(t, archivist.mode)
         
         ## email log
         archivist.email_log(mail_name, mail_pass, mail_to, subject, body, smtp_server, smtp_port)
@@ -186,9 +214,8 @@ if archivist.mode == 'prod':
 if archivist.mode == 'test':
         
         ## email log if there are any failures
-        if archivist.failure > 0:
+        if archivist.ledger.failure > 0:
                 
                 ## compose email message (current log entry)
-                subject = " ".join(['TEST', 'Covid19CanadaArchive Log', t.strftime('%Y-%m-%d %H:%M') + ',', 'Failed:', str(archivist.failure)])
-                body = log
+                subject, body = archivist.ledger.render_email(t, archivist.mode)
                 archivist.email_log(mail_name, mail_pass, mail_to, subject, body, smtp_server, smtp_port)
@@ -9,64 +9,506 @@ import sys
 import os
 import re
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 import pytz  # better time zones
 from shutil import copyfile
 import tempfile
 import csv
+import io
 import json
-from zipfile import ZipFile
+import html.entities
+from html.parser import HTMLParser
+import hashlib
+from zipfile import ZipFile, BadZipFile, is_zipfile
 from array import *
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import random
+from urllib.parse import urlparse
 
 ## other utilities
-import pandas as pd # better data processing
-import numpy as np # better data processing
 from colorit import * # colourful printing
 
 ## web scraping
 import requests
-from selenium import webdriver # requires ChromeDriver and Chromium/Chrome
-from selenium.webdriver.chrome.options import Options
-from bs4 import BeautifulSoup
 
-## Amazon S3
-import boto3
+## slow imports are deferred to the functions that need them, so scripts only pay for what they use (see bench_startup.py):
+## pandas and numpy (file index), selenium (load_webdriver), boto3 (access_s3), smtplib (email_log)
 
-## email
-import smtplib
+## registry of datasets in datasets.json
+import registry
+
+# define classes
+
+class RunLedger:
+    """Results of the downloads of a run, one record per file (see log_result).
+
+    Records are appended under a lock, so results may be recorded from several threads at once (see run_downloads). The log and the email of the run are rendered from the records (see render_log and render_email).
+
+    Attributes:
+    records (list): The records, in the order they were added. Each record is a dictionary with the result (status: 'Success', 'Failure' or 'Unchanged'), the output filename with timestamp, extension and relative path (file), whether the result is written to the log (logged) and, for downloads run by run_downloads, the name (key) and UUID (uuid) of the dataset, the bytes downloaded (bytes) and the durations in seconds of the steps of the download (durations, see duration_fields).
+    counts (dict): Number of records of each status.
+
+    """
+    def __init__(self, records=None):
+        self.lock = threading.Lock()
+        self.records = []
+        self.counts = {'Success': 0, 'Failure': 0, 'Unchanged': 0}
+        for rec in records or []:
+            self.add(rec)
+
+    def add(self, rec):
+        """Add a record.
+
+        Parameters:
+        rec (dict): The record (see records).
+
+        """
+        with self.lock:
+            self.records.append(rec)
+            self.counts[rec['status']] += 1
+
+    @property
+    def success(self):
+        return self.counts['Success']
+
+    @property
+    def failure(self):
+        return self.counts['Failure']
+
+    @property
+    def unchanged(self):
+        return self.counts['Unchanged']
+
+    @property
+    def total(self):
+        return self.success + self.failure + self.unchanged
+
+    def render_log(self, t):
+        """Render the log entry of the run: the number of files of each status, then one line per logged file (failures at the top, successes below, then unchanged files).
+
+        Parameters:
+        t (datetime): Date and time script began running (America/Toronto).
+
+        """
+        with self.lock:
+            lines = [rec['status'] + ': ' + rec['file'] for rec in self.records if rec['logged']]
+        total_files = str(self.total)
+        log = 'Successful downloads : ' + str(self.success) + '/' + total_files + '\n' + 'Failed downloads: ' + str(self.failure) + '/' + total_files + '\n'
+        if self.unchanged > 0:
+            log = log + 'Unchanged downloads: ' + str(self.unchanged) + '/' + total_files + '\n'
+        ## the empty line separates the counts from the files
+        log = log + '\n'.join(sorted(lines + ['']))
+        return str(t) + '\n\n' + 'Nightly update: ' + str(t.date()) + '\n\n' + log
+
+    def render_email(self, t, mode):
+        """Render the email of the run. Returns the subject and the body (the log entry, see render_log).
+
+        Parameters:
+        t (datetime): Date and time script began running (America/Toronto).
+        mode (str): The run mode: 'prod' or 'test'.
+
+        """
+        subject = " ".join([mode.upper(), 'Covid19CanadaArchive Log', t.strftime('%Y-%m-%d %H:%M') + ',', 'Failed:', str(self.failure)])
+        return subject, self.render_log(t)
+
+# define global variables
+
+## results of the current run (see log_result)
+ledger = RunLedger()
+
+## sharded runs: the active datasets are split across several independent runs (shards), whose results are then merged (see set_mode)
+shard = None # (i, n) if this run is shard i of n, None if it handles all datasets (see shard_datasets)
+merge = None # number of shards whose results this run merges (see merge_shards), or None
+shard_isolate_browser = False # if True, shard 1 gets all datasets downloaded with a headless browser and the other shards split the rest
+run_id = None # identifier of a sharded run, given to every shard and to the merge (e.g., the date of the run), so the results of a run are found even if its shards start on different dates
+
+## download functions loading pages in a headless browser
+browser_funs = ['html_page', 'ss_page']
+
+## copies of the state files as they were loaded (see load_state), used to find the entries changed by a run
+states_loaded = {}
+
+## steps of a download whose durations are copied from its event to its record in the ledger (see log_result)
+duration_fields = ['ttfb', 'transfer', 'transform', 'upload', 'upload_wait', 'browser', 'load', 'ready']
+
+## lock protecting the manifest, the HTTP validators and the events
+log_lock = threading.Lock()
+
+## user agent string used when a request should impersonate a normal browser
+user_agent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.14; rv:66.0) Gecko/20100101 Firefox/66.0"
+
+## shared HTTP sessions, keyed by host and user (see get_session)
+sessions = {}
+session_lock = threading.Lock()
+pool_connections = 10 # number of hosts for which each session keeps a connection pool
+pool_maxsize = 2 # number of connections kept alive per host
+
+## size of the chunks in which downloads are written to disk (bytes)
+chunk_size = 1024 * 1024
+
+## timeouts of HTTP requests in seconds: (connect, read)
+## the read timeout is the maximum time between two bytes received, not the total download time
+timeout = (10, 60)
+
+## transient failures after which dl_file may be retried (see run_downloads)
+retry_status = [429, 500, 502, 503, 504] # HTTP status codes
+retry_exceptions = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
+retry_backoff = 5 # base delay in seconds before the first retry, doubled after each attempt
+retry_backoff_max = 120 # maximum delay in seconds before a retry
+
+## maximum number of requests started at once from a single host by the rate limit of run_downloads (size of the token bucket)
+host_burst = 2
+
+## queue of files waiting to be uploaded by the uploaders started by run_downloads (None: files are uploaded by the download functions, see queue_upload)
+upload_queue = None
+upload_queue_size = 8 # maximum number of files waiting to be uploaded, after which downloads wait for space in the queue
+
+## settings of the transfers of upload_file (see access_s3): files larger than the threshold are uploaded in parts, several at once
+upload_multipart_threshold = 8 * 1024 * 1024 # bytes
+upload_multipart_chunksize = 8 * 1024 * 1024 # bytes
+upload_max_concurrency = 4 # parts uploaded at once per file
+transfer_config = None
+
+## timing and metrics of each download run by run_downloads, one dictionary per attempt (see record_event)
+events = []
+## optional path of a file to which events are appended as JSON lines
+events_file = None
+## event of the download running in the current thread, filled in by the download functions (see record)
+event_local = threading.local()
+
+## expected duration in seconds of each dataset, keyed by UUID, learned from the events of past runs (see update_durations)
+## run_downloads starts the datasets expected to take longest first
+dataset_durations = {}
+duration_alpha = 0.5 # weight of the latest run in the expected duration (exponential moving average)
+
+## manifest of the last archived version of each dataset, keyed by S3 directory (see upload_file)
+manifest = {}
+## if True, files identical to the last archived version are not uploaded again
+## off by default: create_index expects one file per dataset per day
+dedup = False
+
+## HTTP validators (ETag, Last-Modified, Content-Length) of the last archived version of each dataset, keyed by UUID
+validators = {}
+## if True, dl_file makes conditional requests using the validators and treats 304 Not Modified as unchanged
+## off by default for the same reason as dedup
+conditional_get = False
+
+## storage of the full log on Amazon S3 (see upload_log)
+## 'segments': the log entry of each run is uploaded as its own object in the root of the archive, log_YYYY-MM-DD_HH-MM.txt (see read_log and compact_log)
+## 'file': the log entry of each run is appended to log.txt, which is downloaded and uploaded in full
+log_storage = 'segments'
+## pattern matching the names of log segments, capturing their timestamp
+log_segment_regex = re.compile(r'^log_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2})\.txt$')
+
+## URLs found on landing pages by find_url and the validators (ETag, Last-Modified) of the landing pages, keyed by landing page, regex and base URL
+url_cache = {}
+
+## pool of headless browsers reused by html_page and ss_page, keyed by user (see get_webdriver)
+webdrivers = {True: [], False: []} # idle browsers
+webdriver_pages = {} # number of pages loaded by each browser
+webdriver_sizes = {} # initial window size of each browser
+webdriver_lock = threading.Lock()
+webdriver_tmpdir = None # download directory shared by the browsers in the pool
+webdriver_max_pages = 25 # recycle a browser after it has loaded this many pages
+webdriver_poll = 0.25 # interval in seconds at which wait_for_page checks if the page is ready
+
+## tags whose contents are not text (see html_text), and void elements, which have no end tag
+html_text_skip = ['script', 'style', 'template', 'rt', 'rp']
+html_void_elements = ['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer']
+
+## columns of the tables embedded as JSON in Alberta webpages (see ab_json_csv), keyed by table
+ab_tables = {
+    'status_map': ["", "Region name", "Measures", "Active case rate (per 100,000 population)", "Active cases", "Population"], # https://www.alberta.ca/maps/covid-19-status-map.htm
+    'school_map': ["", "Region name", "School status", "Schools details", "num_ord"] # https://www.alberta.ca/schools/covid-19-school-status-map.htm
+}
+
+## pattern splitting the file paths in the S3 inventory into the columns of the file index (see process_inventory)
+## e.g., archive/ab/cases/covid19dataexport_2021-01-05_01-51.csv: dir_parent = ab, dir_file = cases, file_timestamp = 2021-01-05_01-51
+inv_path_regex = re.compile(r'^(?:(?:[^/]*/(?:(?P<dir_parent>.+)/)?)?(?P<dir_file>[^/]*)/)?(?P<file_name>(?:[^/]*?_(?P<file_timestamp>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}))?[^/]*)$')
+
+## number of rows in each row group of the columnar file index (readers filtering on a dataset skip the row groups of other datasets)
+index_row_group_size = 10000
 
 # define functions
 
 ## misc functions
 
 def set_mode(run_args=sys.argv, manual=None):
-    global mode
+    """Set the run mode (prod or test) from the arguments of the script.
+
+    The mode may be followed by --shard i/n (run shard i of n, see shard_datasets) or, in prod mode, --merge n (merge the results of n shards, see merge_shards). In prod mode, both require --run <id>, the identifier of the sharded run (letters, digits and hyphens), which must be the same for every shard and the merge.
+
+    Parameters:
+    run_args (list): The arguments of the script. Default: sys.argv.
+    manual (str): Optional. The mode, overriding run_args.
+
+    """
+    global mode, shard, merge, run_id
     print('Setting run mode...')
     if manual is None:
-        if len(run_args) == 2 and run_args[1] == 'prod':
+        args = run_args[1:]
+        ## options follow the mode, each with its value
+        opts = dict(zip(args[1::2], args[2::2]))
+        try:
+            if len(args) % 2 == 0 or len(opts) != len(args) // 2 or any(o not in ['--shard', '--merge', '--run'] for o in opts):
+                raise ValueError
+            if '--shard' in opts:
+                i, n = [int(x) for x in opts['--shard'].split('/')]
+                if not 1 <= i <= n:
+                    raise ValueError
+                shard = (i, n)
+            if '--merge' in opts:
+                merge = int(opts['--merge'])
+                if merge < 1 or args[0] != 'prod' or shard:
+                    raise ValueError
+            if '--run' in opts:
+                if not re.match(r'^[A-Za-z0-9-]+$', opts['--run']):
+                    raise ValueError
+                run_id = opts['--run']
+            ## in prod mode, the results of the shards are matched to the merge by the run id
+            if args[0] == 'prod' and (shard or merge) and run_id is None:
+                raise ValueError
+            args = args[:1]
+        except ValueError:
+            sys.exit('Error: Invalid arguments.')
+        if len(args) == 1 and args[0] == 'prod':
             mode = 'prod'
-        elif len(run_args) == 2 and run_args[1] == 'test':
+        elif len(args) == 1 and args[0] == 'test':
             mode = 'test'
         else:
             sys.exit('Error: Invalid arguments.')
     else:
         mode=manual
     print('Run mode set to ' + mode + '.')
+    if shard:
+        print('Running shard ' + str(shard[0]) + ' of ' + str(shard[1]) + (' of run ' + run_id if run_id else '') + '.')
+    if merge:
+        print('Merging the results of ' + str(merge) + ' shards of run ' + run_id + '.')
 
 def get_datetime(tz):
     t = datetime.now(pytz.timezone(tz))
     return t
 
+def record(**fields):
+    """Add fields to the event of the download running in the current thread (see run_downloads).
+
+    Does nothing if no event is being recorded (e.g., a download function called outside of run_downloads).
+
+    Parameters:
+    **fields: Fields of the event. Durations are in seconds and are rounded to the millisecond.
+
+    """
+    event = getattr(event_local, 'event', None)
+    if event is not None:
+        for k, v in fields.items():
+            event[k] = round(v, 3) if isinstance(v, float) else v
+
+def record_event(event):
+    """Save the event of a finished download in events and, if events_file is set, append it to events_file as a JSON line.
+
+    Parameters:
+    event (dict): The event.
+
+    """
+    with log_lock:
+        events.append(event)
+        if events_file:
+            try:
+                with open(events_file, 'a') as local_file:
+                    local_file.write(json.dumps(event) + '\n')
+            except Exception as e:
+                print(e)
+
+def hold_event(event):
+    """Keep the event of a download open until release_event is called, e.g., while its file waits in the upload queue.
+
+    Parameters:
+    event (dict): The event, or None (nothing to do).
+
+    """
+    if event is not None:
+        with log_lock:
+            event['holds'] = event.get('holds', 1) + 1
+
+def release_event(event):
+    """Release the event of a download (see hold_event): once it is no longer held, it is saved (see record_event).
+
+    The download function holds the event until it returns, and queue_upload until the upload is done.
+
+    Parameters:
+    event (dict): The event, or None (nothing to do).
+
+    """
+    if event is None:
+        return
+    with log_lock:
+        event['holds'] = event.get('holds', 1) - 1
+        done = event['holds'] == 0
+        if done:
+            del event['holds']
+    if done:
+        record_event(event)
+
+def print_events_summary(n=10):
+    """Print the slowest datasets and hosts of the run, from the events recorded by run_downloads.
+
+    The time of a dataset is the sum over all attempts (including retries and the upload). The time of a host is the sum over all its datasets.
+
+    Parameters:
+    n (int): Number of datasets and hosts to print. Default: 10.
+
+    """
+    datasets = {}
+    hosts = {}
+    for event in events:
+        key = event['key']
+        if key not in datasets:
+            datasets[key] = {'host': event['host'], 'total': 0, 'attempts': 0, 'bytes': 0}
+        datasets[key]['total'] += event['total']
+        datasets[key]['attempts'] += 1
+        datasets[key]['bytes'] += event.get('bytes') or 0
+        host = hosts.setdefault(event['host'], {'total': 0, 'attempts': 0})
+        host['total'] += event['total']
+        host['attempts'] += 1
+    print('Slowest datasets:')
+    for key in sorted(datasets, key=lambda k: datasets[k]['total'], reverse=True)[:n]:
+        d = datasets[key]
+        print('{:8.1f} s  {:>3} attempt(s)  {:>12,} bytes  {} ({})'.format(d['total'], d['attempts'], d['bytes'], key, d['host']))
+    print('Slowest hosts:')
+    for key in sorted(hosts, key=lambda k: hosts[k]['total'], reverse=True)[:n]:
+        h = hosts[key]
+        print('{:8.1f} s  {:>3} attempt(s)  {}'.format(h['total'], h['attempts'], key))
+
 def print_success_failure():
-    global success, failure
-    total_files = str(success + failure)
-    print(background('Successful downloads: ' + str(success) + '/' + total_files, Colors.blue))
-    print(background('Failed downloads: ' + str(failure) + '/' + total_files, Colors.red))    
+    total_files = str(ledger.total)
+    print(background('Successful downloads: ' + str(ledger.success) + '/' + total_files, Colors.blue))
+    print(background('Failed downloads: ' + str(ledger.failure) + '/' + total_files, Colors.red))    
+    if ledger.unchanged > 0:
+        print(background('Unchanged downloads: ' + str(ledger.unchanged) + '/' + total_files, Colors.purple))
+
+def log_result(full_name, status, write_log=True):
+    """Record the result of a download in the ledger of the run (see RunLedger).
+
+    If the download is run by run_downloads, the record includes the name and UUID of the dataset, the bytes downloaded and the durations recorded so far in its event.
+
+    Parameters:
+    full_name (str): Output filename with timestamp, extension and relative path.
+    status (str): Result of the download: 'Success', 'Failure' or 'Unchanged' (identical to the last archived version, so not uploaded).
+    write_log (bool): Should the result be written to the download log? Default: True.
+
+    """
+    record(status=status, file=full_name)
+    event = getattr(event_local, 'event', None) or {}
+    ledger.add({
+        'status': status,
+        'file': full_name,
+        'logged': write_log,
+        'key': event.get('key'),
+        'uuid': event.get('uuid'),
+        'bytes': event.get('bytes'),
+        'durations': {k: event[k] for k in duration_fields if k in event}
+    })
+
+def get_session(url, user=False):
+    """Return the shared HTTP session for the host of a URL.
+
+    Sessions keep connections alive between requests, so datasets hosted on the same server only pay for the TCP and TLS handshakes once. The size of the connection pools is set by pool_connections and pool_maxsize, which should be at least the number of simultaneous downloads allowed per host.
+
+    Parameters:
+    url (str): URL that will be requested with the session.
+    user (bool): Should the session impersonate a normal browser? Default: False.
+
+    """
+    key = (urlparse(url).netloc, user)
+    with session_lock:
+        if key not in sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            ## some websites will reject the request unless you look like a normal web browser
+            if user:
+                session.headers.update({"User-Agent": user_agent})
+            sessions[key] = session
+        return sessions[key]
+
+def write_response(req, f_path):
+    """Write the body of a streamed response to a file.
+
+    The body is written in chunks of chunk_size bytes, so memory use does not depend on the size of the download. Returns the number of bytes written.
+
+    Parameters:
+    req (requests.Response): Response from a request made with stream=True.
+    f_path (str): The path to the local file to write.
+
+    """
+    n = 0
+    with open(f_path, mode='wb') as local_file:
+        for chunk in req.iter_content(chunk_size=chunk_size):
+            local_file.write(chunk)
+            n += len(chunk)
+    return n
 
 def find_url(search_url, regex, base_url):
-    url = base_url + re.search(regex, requests.get(search_url).text).group(0)
+    """Find the URL of a dataset on a landing page (used by url_fun_python in datasets.json).
+
+    The URL is base_url followed by the first match of regex in the landing page. If the landing page sent validators (ETag, Last-Modified) when the URL was last found, the page is requested conditionally and, if it is not modified, the cached URL is returned without downloading or searching the page (see url_cache).
+
+    Parameters:
+    search_url (str): URL of the landing page.
+    regex (str): Regular expression matching the URL (or its path) in the landing page.
+    base_url (str): Prefix of the URL. Example: 'https://dashboard.saskatchewan.ca'.
+
+    """
+    key = search_url + ' ' + regex + ' ' + base_url
+    cached = url_cache.get(key)
+    headers = {}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    req = get_session(search_url).get(search_url, headers=headers, timeout=timeout)
+    if req.status_code == 304 and cached:
+        return cached['url']
+    url = base_url + re.search(regex, req.text).group(0)
+    ## cache the URL if the landing page can be requested conditionally next time
+    if req.headers.get('ETag') or req.headers.get('Last-Modified'):
+        with log_lock:
+            url_cache[key] = {
+                'etag': req.headers.get('ETag'),
+                'last_modified': req.headers.get('Last-Modified'),
+                'url': url
+            }
     return url
 
+def resolve_urls(datasets, workers=1):
+    """Compute the URLs of the datasets with a dynamic URL by running their url_fun_python code, concurrently.
+
+    Run before the downloads start, so landing pages are not requested one at a time in the middle of the downloads. Returns a dictionary of URLs keyed by UUID, where the URL is None if it could not be found.
+
+    Parameters:
+    datasets (list): Datasets from the registry (see registry.py). Datasets with a static URL are ignored.
+    workers (int): Maximum number of landing pages to request at once. Default: 1 (serial).
+
+    """
+    dynamic = [d for d in datasets if d.url is None]
+    def resolve(d):
+        try:
+            url = d.url_fun()
+            print(d.id_name + ': ' + url)
+            return url
+        except Exception as e:
+            print(e)
+            print(background('Error finding URL: ' + d.id_name, Colors.red))
+            return None
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        urls = list(executor.map(resolve, dynamic))
+    return {d.uuid: url for d, url in zip(dynamic, urls)}
+
 ## functions for Amazon S3
 
 def access_s3(bucket):
@@ -77,6 +519,8 @@ def access_s3(bucket):
     
     """
     global mode
+    import boto3
+    
     print('Authenticating with AWS...') 
     ## connect to AWS
     aws = boto3.Session(
@@ -86,6 +530,11 @@ def access_s3(bucket):
     
     ## connect to S3 bucket
     s3 = aws.resource('s3').Bucket(bucket)
+
+    ## set up multipart uploads (see upload_file)
+    global transfer_config
+    from boto3.s3.transfer import TransferConfig
+    transfer_config = TransferConfig(multipart_threshold=upload_multipart_threshold, multipart_chunksize=upload_multipart_chunksize, max_concurrency=upload_max_concurrency)
     
     ## confirm authentication was successful
     print('Authentication was successful.')    
@@ -93,9 +542,85 @@ def access_s3(bucket):
     ## return s3 object
     return s3
 
+def file_md5(f_path):
+    """Calculate the MD5 hash of a local file (the same hash S3 uses as the ETag of single-part uploads).
+
+    Parameters:
+    f_path (str): The path to the local file.
+
+    """
+    md5 = hashlib.md5()
+    with open(f_path, mode='rb') as local_file:
+        for chunk in iter(lambda: local_file.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def load_state(f_name):
+    """Load a JSON state file kept in the root of the archive on Amazon S3.
+
+    State files carry information from one run to the next (e.g., the manifest of the last archived version of each dataset). If the file does not exist yet, an empty dictionary is returned.
+
+    Parameters:
+    f_name (str): Name of the state file. Example: 'manifest.json'.
+
+    """
+    global s3, prefix_root
+    print('Loading ' + f_name + '...')
+    try:
+        tmpdir = tempfile.TemporaryDirectory()
+        state_file = os.path.join(tmpdir.name, f_name)
+        s3.download_file(Filename=state_file, Key=prefix_root + '/' + f_name)
+        with open(state_file, 'r') as local_file:
+            state = json.load(local_file)
+        states_loaded[f_name] = json.loads(json.dumps(state))
+        print(color(f_name + ' loaded!', Colors.green))
+    except:
+        print(background(f_name + ' could not be loaded, starting from scratch.', Colors.red))
+        state = {}
+    return state
+
+def upload_state(state, f_name):
+    """Upload a JSON state file to the root of the archive on Amazon S3.
+
+    Returns True if the file was uploaded and False if the upload failed.
+
+    Parameters:
+    state (dict): The state to save.
+    f_name (str): Name of the state file. Example: 'manifest.json'.
+
+    """
+    global s3, prefix_root
+    print('Uploading ' + f_name + '...')
+    try:
+        tmpdir = tempfile.TemporaryDirectory()
+        state_file = os.path.join(tmpdir.name, f_name)
+        with open(state_file, 'w') as local_file:
+            json.dump(state, local_file, indent=2, sort_keys=True)
+        s3.upload_file(Filename=state_file, Key=prefix_root + '/' + f_name)
+        print(color(f_name + ' upload successful!', Colors.green))
+        return True
+    except:
+        print(background(f_name + ' upload failed!', Colors.red))
+        return False
+
+def delete_objects(keys):
+    """Delete objects from Amazon S3.
+
+    Parameters:
+    keys (list): Keys of the objects. Example: ['archive/log_2021-01-05_23-15.txt'].
+
+    """
+    global s3
+    for i in range(0, len(keys), 1000): # maximum number of keys per request
+        s3.delete_objects(Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]]})
+
 def upload_file(full_name, f_path, s3_dir=None, s3_prefix=None):
     """Upload local file to Amazon S3.
 
+    The MD5 hash of the file is recorded in the manifest under s3_dir. If dedup is True and the hash matches the last archived version in s3_dir, the upload is skipped and the file is logged as unchanged.
+
+    Returns True if the file was uploaded or unchanged and False if the upload failed.
+
     Parameters:
     full_name (str): Output filename with timestamp, extension and relative path.
     f_path (str): The path to the local file to upload.
@@ -103,7 +628,7 @@ def upload_file(full_name, f_path, s3_dir=None, s3_prefix=None):
     s3_prefix (str): Optional. The prefix to the directory on Amazon S3.
 
     """
-    global s3, download_log, success, failure
+    global s3, manifest, dedup, transfer_config
     
     ## generate file name
     f_name = os.path.basename(full_name)
@@ -113,54 +638,107 @@ def upload_file(full_name, f_path, s3_dir=None, s3_prefix=None):
         f_name = os.path.join(s3_prefix, f_name)
     ## upload file to Amazon S3
     try:
+        ## skip upload if file is identical to the last archived version
+        md5 = file_md5(f_path)
+        if dedup and s3_dir and manifest.get(s3_dir, {}).get('md5') == md5:
+            log_result(full_name, 'Unchanged')
+            print(color('Unchanged since last upload: ' + full_name, Colors.purple))
+            return True
         ## file upload
-        s3.upload_file(Filename=f_path, Key=f_name)
+        start = time.monotonic()
+        if transfer_config is None:
+            s3.upload_file(Filename=f_path, Key=f_name)
+        else:
+            s3.upload_file(Filename=f_path, Key=f_name, Config=transfer_config)
+        record(upload=time.monotonic() - start, upload_bytes=os.path.getsize(f_path))
+        ## record hash of the last archived version
+        if s3_dir:
+            with log_lock:
+                manifest[s3_dir] = {'md5': md5, 'key': f_name}
         ## append name of file to the log message
-        download_log = download_log + 'Success: ' + full_name + '\n'
+        log_result(full_name, 'Success')
         print(color('Upload successful: ' + full_name, Colors.blue))
-        success+=1
+        return True
     except:
-        download_log = download_log + 'Failure: ' + full_name + '\n'
+        log_result(full_name, 'Failure')
         print(background('Upload failed: ' + full_name, Colors.red))
-        failure+=1
+        return False
 
-## functions for logging
+def queue_upload(full_name, f_path, tmpdir, s3_dir=None, s3_prefix=None, callback=None):
+    """Upload local file to Amazon S3, in the background if the uploaders of run_downloads are running.
+
+    If upload_queue is set, the file is put in the queue and the download function returns without waiting for the upload (see run_uploads). The queue is bounded, so a download waits for space in the queue rather than piling up temporary files. Otherwise, the file is uploaded at once (see upload_file). Either way, the result is recorded by upload_file.
 
-def output_log(download_log, t):
-    """Assemble log from current run.
-    
     Parameters:
-    download_log (str): Raw text of the download log.
-    t (datetime): Date and time script began running (America/Toronto).
-    
+    full_name (str): Output filename with timestamp, extension and relative path.
+    f_path (str): The path to the local file to upload.
+    tmpdir (tempfile.TemporaryDirectory): The temporary directory containing the file, kept until the upload is done.
+    s3_dir(str): Optional. The directory on Amazon S3.
+    s3_prefix (str): Optional. The prefix to the directory on Amazon S3.
+    callback (function): Optional. Called without arguments if the file was uploaded or is unchanged (e.g., to save the HTTP validators of the archived version).
+
     """
-    global success, failure
+    q = upload_queue
+    if q is None:
+        if upload_file(full_name, f_path, s3_dir=s3_dir, s3_prefix=s3_prefix) and callback:
+            callback()
+        return
+    ## the event of the download is completed by the uploader
+    event = getattr(event_local, 'event', None)
+    hold_event(event)
+    q.put((full_name, f_path, tmpdir, s3_dir, s3_prefix, callback, event, time.monotonic()))
+
+def run_uploads(q):
+    """Upload the files in an upload queue (see queue_upload) until None is taken from the queue.
 
-    ## process download log: place failures at the top, successes below
-    download_log = download_log.split('\n')
-    download_log.sort()
-    download_log = '\n'.join(download_log)
+    Parameters:
+    q (queue.Queue): The upload queue.
 
-    ## count total files
-    total_files = str(success + failure)
+    """
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        full_name, f_path, tmpdir, s3_dir, s3_prefix, callback, event, queued = item
+        ## record the upload in the event of the download
+        event_local.event = event
+        try:
+            record(upload_wait=time.monotonic() - queued)
+            if upload_file(full_name, f_path, s3_dir=s3_dir, s3_prefix=s3_prefix) and callback:
+                callback()
+        except Exception as e:
+            ## upload_file handles its own errors, so this should not happen
+            print(e)
+            print(background('Error running upload: ' + full_name, Colors.red))
+        finally:
+            event_local.event = None
+            tmpdir.cleanup()
+            release_event(event)
 
-    ## assemble log
-    log = 'Successful downloads : ' + str(success) + '/' + total_files + '\n' + 'Failed downloads: ' + str(failure) + '/' + total_files + '\n' + download_log
-    log = str(t) + '\n\n' + 'Nightly update: ' + str(t.date()) + '\n\n' + log
+## functions for logging
 
-    ## return log
-    return log
+def output_log(t):
+    """Assemble log from current run (see RunLedger.render_log).
+    
+    Parameters:
+    t (datetime): Date and time script began running (America/Toronto).
+    
+    """
+    return ledger.render_log(t)
 
-def upload_log(log):
+def upload_log(log, t=None):
     """Upload the log of file uploads to Amazon S3.
 
-    The most recent log entry is placed in a separate file for easy access.
+    The most recent log entry is placed in a separate file for easy access. The entry is then added to the full log, as a log segment or by appending it to log.txt (see log_storage).
+
+    Returns True if the entry was added to the full log and False if that upload failed (the recent log is only a copy).
 
     Parameters:
     log (str): Log entry from current run.
+    t (datetime): Optional. Date and time script began running (America/Toronto), used to name the log segment. Default: now.
 
     """
-    global s3, success, failure
+    global s3, log_storage
     print("Uploading recent log...")
     try:
         ## write most recent log entry temporarily and upload
@@ -174,6 +752,20 @@ def upload_log(log):
         print(color('Recent log upload successful!', Colors.green))
     except:
         print(background('Recent log upload failed!', Colors.red))
+    if log_storage == 'segments':
+        print("Uploading log segment...")
+        try:
+            ## upload log entry as its own object: the cost does not depend on the size of the full log
+            if t is None:
+                t = get_datetime('America/Toronto')
+            s3.upload_file(Filename=log_file, Key='archive/log_' + t.strftime('%Y-%m-%d_%H-%M') + '.txt')
+
+            ## report success
+            print(color('Log segment upload successful!', Colors.green))
+            return True
+        except:
+            print(background('Log segment upload failed!', Colors.red))
+            return False
     print("Appending recent log to full log...")
     try:
         ## read in full log
@@ -195,8 +787,115 @@ def upload_log(log):
 
         ## report success
         print(color('Full log upload successful!', Colors.green))
+        return True
     except:
         print(background('Full log upload failed!', Colors.red))
+        return False
+
+def list_log_segments(start=None, end=None):
+    """List the log segments on Amazon S3, in chronological order, as (key, timestamp) tuples.
+
+    Parameters:
+    start (str): Optional. Only list segments from this date (YYYY-MM-DD) onwards.
+    end (str): Optional. Only list segments up to this date (YYYY-MM-DD), inclusive.
+
+    """
+    global s3
+    segments = []
+    for obj in s3.objects.filter(Prefix='archive/log_'):
+        m = log_segment_regex.match(obj.key[len('archive/'):])
+        if m is None:
+            continue
+        if start is not None and m.group(1)[:10] < start:
+            continue
+        if end is not None and m.group(1)[:10] > end:
+            continue
+        segments.append((obj.key, m.group(1)))
+    return sorted(segments, key=lambda seg: seg[1])
+
+def read_log_object(key):
+    """Read a text object on Amazon S3 (e.g., a log segment). Returns None if it does not exist.
+
+    Parameters:
+    key (str): Key of the object. Example: 'archive/log.txt'.
+
+    """
+    global s3
+    try:
+        tmpdir = tempfile.TemporaryDirectory()
+        log_file = os.path.join(tmpdir.name, 'log.txt')
+        s3.download_file(Filename=log_file, Key=key)
+        with open(log_file, 'r') as local_file:
+            return local_file.read()
+    except Exception:
+        return None
+
+def read_log(start=None, end=None):
+    """Return the full log, stitched together from log.txt and the log segments (see log_storage).
+
+    log.txt holds the entries of runs before log segments were used or compacted (see compact_log), so it is only included when start is None.
+
+    Parameters:
+    start (str): Optional. Only include log segments from this date (YYYY-MM-DD) onwards.
+    end (str): Optional. Only include log segments up to this date (YYYY-MM-DD), inclusive.
+
+    """
+    entries = []
+    if start is None:
+        full_log = read_log_object('archive/log.txt')
+        if full_log:
+            entries.append(full_log)
+    for key, timestamp in list_log_segments(start, end):
+        entry = read_log_object(key)
+        if entry is None:
+            print(background('Log segment could not be read: ' + key, Colors.red), file=sys.stderr)
+            continue
+        entries.append(entry)
+    return '\n\n'.join(entries)
+
+def compact_log(before=None):
+    """Append log segments to log.txt, in chronological order, and remove them from Amazon S3.
+
+    The segments are only removed once the new log.txt is uploaded. Returns the number of segments compacted.
+
+    Parameters:
+    before (str): Optional. Only compact log segments of dates before this date (YYYY-MM-DD). Default: all log segments.
+
+    """
+    global s3
+    segments = list_log_segments()
+    if before is not None:
+        segments = [seg for seg in segments if seg[1][:10] < before]
+    if len(segments) == 0:
+        print('No log segments to compact.')
+        return 0
+    print('Compacting ' + str(len(segments)) + ' log segments...')
+
+    ## stitch log.txt and segments together
+    entries = []
+    full_log = read_log_object('archive/log.txt')
+    if full_log:
+        entries.append(full_log)
+    for key, timestamp in segments:
+        entry = read_log_object(key)
+        if entry is None:
+            print(background('Log segment could not be read, compaction aborted: ' + key, Colors.red))
+            return 0
+        entries.append(entry)
+
+    ## upload new log.txt, then remove compacted segments
+    try:
+        tmpdir = tempfile.TemporaryDirectory()
+        log_file = os.path.join(tmpdir.name, 'log.txt')
+        with open(log_file, 'w') as local_file:
+            local_file.write('\n\n'.join(entries))
+        s3.upload_file(Filename=log_file, Key='archive/log.txt')
+    except:
+        print(background('Full log upload failed, compaction aborted!', Colors.red))
+        return 0
+    delete_objects([key for key, timestamp in segments])
+    print(color('Log compaction successful!', Colors.green))
+    return len(segments)
 
 def email_log(mail_name, mail_pass, mail_to, subject, body, smtp_server, smtp_port):
     """Email log of current run.
@@ -211,6 +910,7 @@ def email_log(mail_name, mail_pass, mail_to, subject, body, smtp_server, smtp_po
     smtp_port (int): SMTP server port.
     
     """
+    import smtplib
     
     ## compose message
     email_text = """\
@@ -234,16 +934,453 @@ Subject: %s
         print(e)
         print('Log failed to send.')
 
+## functions for converting downloaded files
+
+class HTMLTextParser(HTMLParser):
+    """Parser collecting the text of HTML markup (see html_text).
+
+    Follows the rules of BeautifulSoup's html.parser tree builder without building the tree: strings containing only whitespace are collapsed to a single space or newline (except inside pre and textarea), character references are decoded and comments, declarations, processing instructions and the contents of script, style, template, rt and rp are dropped.
+
+    """
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=False)
+        self.text = [] # strings kept
+        self.data = [] # pieces of the current string
+        self.tags = [] # open tags
+        self.closed = [] # void elements closed at their start tag (their end tag, if any, is ignored)
+
+    def end_data(self, cdata=False):
+        if self.data:
+            data = ''.join(self.data)
+            self.data = []
+            if not ('pre' in self.tags or 'textarea' in self.tags) and all(c in ' \n\t\x0c\r' for c in data):
+                data = '\n' if '\n' in data else ' '
+            if cdata or not any(tag in html_text_skip for tag in self.tags):
+                self.text.append(data)
+
+    def handle_starttag(self, tag, attrs):
+        self.end_data()
+        self.tags.append(tag)
+        if tag in html_void_elements:
+            self.tags.pop()
+            self.closed.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.end_data()
+
+    def handle_endtag(self, tag):
+        if tag in self.closed:
+            self.closed.remove(tag)
+            return
+        self.end_data()
+        if tag in self.tags:
+            del self.tags[len(self.tags) - 1 - self.tags[::-1].index(tag):]
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_entityref(self, name):
+        self.data.append(html.entities.html5.get(name + ';', '&' + name))
+
+    def handle_charref(self, name):
+        base = 16 if name[:1] in ['x', 'X'] else 10
+        digits = name[1:] if base == 16 else name
+        extra = ''
+        try:
+            n = int(digits, base)
+        except ValueError:
+            ## reference not terminated by a semicolon: the rest is data
+            match = re.match('([0-9a-f]+)(.*)' if base == 16 else '([0-9]+)(.*)', digits, flags=re.DOTALL)
+            if match is None:
+                self.data.append(digits)
+                return
+            n = int(match.group(1), base)
+            extra = match.group(2)
+        if n == 0 or n > 0x10ffff or 0xd800 <= n <= 0xdfff:
+            char = '�'
+        elif 0x80 <= n <= 0x9f:
+            ## like browsers, decode references to C1 control characters as Windows-1252
+            char = bytes([n]).decode('windows-1252', errors='ignore') or chr(n)
+        else:
+            char = chr(n)
+        self.data.append(char + extra)
+
+    def handle_comment(self, data):
+        self.end_data()
+
+    def handle_decl(self, decl):
+        self.end_data()
+
+    def handle_pi(self, data):
+        self.end_data()
+
+    def unknown_decl(self, data):
+        self.end_data()
+        if data.upper().startswith('CDATA['):
+            self.data.append(data[len('CDATA['):])
+            self.end_data(cdata=True)
+
+def html_text(markup):
+    """Return the text of HTML markup, as BeautifulSoup(markup, features='html.parser').get_text() would.
+
+    Parameters:
+    markup (str): The HTML markup.
+
+    """
+    parser = HTMLTextParser()
+    parser.feed(markup)
+    parser.close()
+    parser.end_data()
+    return ''.join(parser.text)
+
+def infer_column(values):
+    """Return the type pandas infers for a column built from JSON values and the values converted to that type.
+
+    The type is 'int', 'uint' (integers of 2^63 or more), 'float', 'bool' or 'object' (strings, lists, dictionaries or mixed values, kept as they are). Missing values (None) make a column of numbers 'float' (None becomes NaN) and a column of booleans 'object'.
+
+    Parameters:
+    values (list): The values of the column.
+
+    """
+    seen = set()
+    for v in values:
+        if v is None:
+            seen.add('null')
+        elif isinstance(v, bool):
+            seen.add('bool')
+        elif isinstance(v, int):
+            if v < -2 ** 63 or v >= 2 ** 64:
+                return 'object', values
+            seen.add('uint' if v >= 2 ** 63 else 'sint' if v < 0 else 'int')
+        elif isinstance(v, float):
+            seen.add('float')
+        else:
+            return 'object', values
+    if not seen or seen == {'null'}:
+        return 'object', values
+    if 'bool' in seen:
+        return ('bool', values) if seen == {'bool'} else ('object', values)
+    if {'uint', 'sint'} <= seen:
+        return 'object', values
+    if seen & {'null', 'float'}:
+        return 'float', [float('nan') if v is None else float(v) for v in values]
+    return ('uint' if 'uint' in seen else 'int'), values
+
+def json_column(kind, values):
+    """Convert a column the way pd.read_json does (floats, and numbers in strings, become integers if they are all whole).
+
+    Returns the converted type and values (see infer_column).
+
+    Parameters:
+    kind (str): The type of the column.
+    values (list): The values of the column.
+
+    """
+    if kind == 'object':
+        try:
+            values = [float('nan') if v is None else float(v) for v in values]
+            kind = 'float'
+        except (TypeError, ValueError):
+            return kind, values
+    if kind == 'float' and values and all(v == v and -2 ** 63 <= v < 2 ** 63 for v in values) and all(v == int(v) for v in values):
+        return 'int', [int(v) for v in values]
+    return kind, values
+
+def csv_value(v):
+    """Format a value as pandas writes it to CSV (missing values are empty).
+
+    Parameters:
+    v: The value.
+
+    """
+    if v is None or (isinstance(v, float) and v != v):
+        return ''
+    return str(v)
+
+def epoch_ms_date(ms):
+    """Convert a timestamp in milliseconds to a date, as pd.to_datetime(ms / 1000, unit='s').dt.date does (None if ms is missing).
+
+    Parameters:
+    ms (float): The timestamp in milliseconds since 1970-01-01 (UTC).
+
+    """
+    if ms is None or ms != ms:
+        return None
+    s = float(ms) / 1000
+    if not -9.223372036854776e18 <= float(int(s)) * 1e9 <= 9.223372036854776e18:
+        raise ValueError('Timestamp out of bounds: ' + str(ms))
+    ns = int(s * 1e9) # truncated to the nanosecond, like pandas
+    return date(1970, 1, 1) + timedelta(days=ns // 86400000000000)
+
+def ab_json_csv(text, table):
+    """Extract the table embedded as JSON in an Alberta webpage and return it as CSV text.
+
+    The CSV matches the download on the website: all fields are quoted and the last line does not end with a new line.
+
+    Parameters:
+    text (str): The HTML of the webpage.
+    table (str): The table in the webpage, which determines its columns (see ab_tables): 'status_map' or 'school_map'.
+
+    """
+    data = re.search("(?<=\"data\"\:)\[\[.*\]\]", text).group(0)
+    if table == 'status_map':
+        data = html_text(data) # strip HTML tags
+        ## this regex may need some tweaking if measures column changes in the future
+        data = re.sub("<\\\/a><\\\/li><\\\/ul>", "", data) # strip remaining tags
+        data = re.sub("(?<=\") ", "", data) # strip whitespace
+        data = re.sub(" (?=\")", "", data) # strip whitespace
+    elif table == 'school_map':
+        data = re.sub(',"container":.*', "", data) # strip remaining tags
+    else:
+        raise ValueError('Unknown Alberta table: ' + table)
+    names = ab_tables[table]
+
+    ## the JSON is a list of columns: each row of the table is one position in every column
+    cols = json.loads(data)
+    n_rows = max([len(col) for col in cols], default=0)
+    kinds, rows = [], []
+    for i in range(n_rows):
+        kind, row = infer_column([col[i] if i < len(col) else None for col in cols])
+        kind, row = json_column(kind, row)
+        kinds.append(kind)
+        rows.append(row)
+    ## rows share one type in the table: mixed numbers become floats, anything else mixed is kept as it is
+    if len(set(kinds)) > 1 and set(kinds) <= {'int', 'uint', 'float'}:
+        rows = [[float(v) for v in row] for row in rows]
+    header = names[:len(cols)] + [str(j) for j in range(len(names), len(cols))]
+    if table == 'school_map':
+        if len(cols) < 5:
+            raise KeyError('num_ord')
+        ## convert first column and num_ord to int and sort ascending by num_ord and first column (like CSV output on website)
+        for row in rows:
+            row[4] = int(str(row[4]))
+            row[0] = int(str(row[0]))
+        rows.sort(key=lambda row: (row[4], row[0]))
+
+    ## write CSV (quote all fields, don't terminate with new line)
+    out = io.StringIO()
+    writer = csv.writer(out, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    writer.writerow(header)
+    writer.writerows([[csv_value(v) for v in row] for row in rows])
+    return out.getvalue()[:-1]
+
+def mb_json_csv(content):
+    """Convert a Manitoba JSON file (ArcGIS features) to CSV text.
+
+    Each feature is a row and its nested objects (e.g., attributes) are flattened into columns, with the 'attributes.' prefix stripped from their names. Dates (timestamps in milliseconds) in the Date column are converted to YYYY-MM-DD.
+
+    Parameters:
+    content (bytes): The JSON file.
+
+    """
+    features = json.loads(content)['features']
+
+    ## flatten nested objects: the top-level values come first, then the nested values (e.g., attributes.Date)
+    def flatten(obj, prefix, flat):
+        for k, v in obj.items():
+            key = prefix + '.' + str(k)
+            key = key[1:] if key[0] == '.' else key
+            if isinstance(v, dict):
+                flatten(v, key, flat)
+            else:
+                flat[key] = v
+        return flat
+    records = []
+    for feature in features:
+        top = {k: v for k, v in feature.items() if not isinstance(v, dict)}
+        records.append({**top, **flatten({k: v for k, v in feature.items() if isinstance(v, dict)}, '', {})})
+
+    ## columns in order of first appearance, missing values are empty
+    keys = list(dict.fromkeys(k for record in records for k in record))
+    names = [k.lstrip('attributes.') for k in keys]
+    cols = []
+    for k in keys:
+        cols.append(infer_column([record.get(k, float('nan')) for record in records]))
+    ## replace timestamps with actual dates
+    if names.count('Date') > 1:
+        raise ValueError('More than one Date column')
+    if names.count('Date') == 1:
+        kind, col = cols[names.index('Date')]
+        if kind not in ['int', 'uint', 'float', 'bool'] and any(v is not None for v in col):
+            raise TypeError('Date is not a timestamp')
+        cols[names.index('Date')] = ('object', [epoch_ms_date(v) for v in col])
+
+    ## write CSV
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    if keys:
+        writer.writerow(names)
+    else:
+        out.write('\n') # no columns: empty header
+    writer.writerows([[csv_value(col[i]) for kind, col in cols] for i in range(len(records))])
+    return out.getvalue()
+
+## transforms applied to downloaded files before upload (see run_transforms)
+## each transform takes the path of the file, the argument given in datasets.json (or None) and the download (see dl_file)
+## and returns the path of the transformed file, or the same path if the transform does not apply to the file
+
+def transform_path(dl):
+    """Return a new path for a transformed file, in the temporary directory of the download.
+
+    Parameters:
+    dl (dict): The download (see dl_file).
+
+    """
+    return os.path.join(tempfile.mkdtemp(dir=dl['tmpdir']), dl['file'] + dl['ext'])
+
+def decode_text(content, encoding=None):
+    """Decode the body of a response as requests.Response.text does.
+
+    Parameters:
+    content (bytes): The body of the response.
+    encoding (str): The encoding declared by the response (requests.Response.encoding). If None, the encoding is detected from the content.
+
+    """
+    if not content:
+        return ''
+    if encoding is None:
+        encoding = requests.compat.chardet.detect(content)['encoding'] if requests.compat.chardet is not None else 'utf-8'
+    try:
+        return str(content, encoding, errors='replace')
+    except (LookupError, TypeError):
+        return str(content, errors='replace')
+
+def csv_number(v):
+    """Convert a value read from a CSV file to a number, if it is one (like pd.read_csv).
+
+    Parameters:
+    v (str): The value.
+
+    """
+    for num in (int, float):
+        try:
+            return num(v)
+        except ValueError:
+            pass
+    return v
+
+def unzip(f_path, arg, dl):
+    """Transform: extract the files in a zip archive. Returns the directory they are extracted to (see select_member).
+
+    Raises BadZipFile if the file is not a zip archive (e.g., an error page returned with status 200), so the download fails instead of archiving the wrong file.
+
+    Parameters:
+    f_path (str): The path of the file.
+    arg (str): Not used.
+    dl (dict): The download (see dl_file).
+
+    """
+    if not is_zipfile(f_path):
+        raise BadZipFile('File is not a zip file: ' + dl['file'] + dl['ext'])
+    out = tempfile.mkdtemp(dir=dl['tmpdir'])
+    with ZipFile(f_path, 'r') as zip_file:
+        zip_file.extractall(out)
+    return out
+
+def select_member(f_path, arg, dl):
+    """Transform: select a file extracted from an archive (see unzip). Raises an error if the file is not found in the archive.
+
+    Parameters:
+    f_path (str): The directory the files are extracted to.
+    arg (str): The name of the file. If None, the output file name (including extension).
+    dl (dict): The download (see dl_file).
+
+    """
+    if not os.path.isdir(f_path):
+        raise ValueError('select_member requires the files extracted by unzip: ' + dl['file'] + dl['ext'])
+    member = os.path.join(f_path, arg if arg else dl['file'] + dl['ext'])
+    if not os.path.isfile(member):
+        raise FileNotFoundError('File not found in archive: ' + os.path.basename(member))
+    return member
+
+def pivot(f_path, arg, dl):
+    """Transform: pivot a CSV file from long to wide, keeping only the index columns and the pivoted columns.
+
+    Rows are sorted by the index columns and the pivoted columns are in order of first appearance. Numbers are written unquoted, all other values are quoted. As in pandas, pivoted numbers are written as floats if any of them is a float or any cell is empty. The file is read row by row, so only the pivoted table is kept in memory.
+
+    Parameters:
+    f_path (str): The path of the file.
+    arg (str): The columns to pivot: "<index columns, separated by commas>|<columns column>|<values column>". Example: "REF_DATE,Case identifier number|Case information|VALUE".
+    dl (dict): The download (see dl_file).
+
+    """
+    index, columns, values = arg.split('|')
+    index = index.split(',')
+    table = {}
+    cols = {} # pivoted columns in order of first appearance
+    with open(f_path, newline='', encoding='utf-8-sig') as local_file:
+        for row in csv.DictReader(local_file):
+            cols.setdefault(row[columns], None)
+            table.setdefault(tuple(csv_number(row[i]) for i in index), {})[row[columns]] = csv_number(row[values])
+    cells = [v for row in table.values() for v in row.values()]
+    if any(isinstance(v, float) for v in cells) or len(cells) < len(table) * len(cols):
+        for row in table.values():
+            for col in row:
+                row[col] = float(row[col]) if isinstance(row[col], int) else row[col]
+    out = transform_path(dl)
+    with open(out, 'w', newline='', encoding='utf-8') as local_file:
+        writer = csv.writer(local_file, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+        writer.writerow(index + list(cols))
+        for key in sorted(table):
+            writer.writerow(list(key) + [table[key].get(col, '') for col in cols])
+    return out
+
+def json_to_csv(f_path, arg, dl):
+    """Transform: convert a JSON file to CSV.
+
+    Parameters:
+    f_path (str): The path of the file.
+    arg (str): The format of the JSON file: 'ab_status_map' or 'ab_school_map' (table embedded in an Alberta webpage, see ab_json_csv) or 'mb_features' (Manitoba ArcGIS features, see mb_json_csv).
+    dl (dict): The download (see dl_file).
+
+    """
+    with open(f_path, 'rb') as local_file:
+        content = local_file.read()
+    if arg == 'ab_status_map':
+        data = ab_json_csv(decode_text(content, dl['encoding']), 'status_map')
+    elif arg == 'ab_school_map':
+        data = ab_json_csv(decode_text(content, dl['encoding']), 'school_map')
+    elif arg == 'mb_features':
+        data = mb_json_csv(content)
+    else:
+        raise ValueError('Unknown JSON format: ' + str(arg))
+    out = transform_path(dl)
+    with open(out, 'w', newline='', encoding='utf-8') as local_file:
+        local_file.write(data)
+    return out
+
+## transforms a dataset may list in datasets.json, keyed by name (see registry.transforms)
+transform_funs = {
+    'unzip': unzip,
+    'select_member': select_member,
+    'pivot': pivot,
+    'json_to_csv': json_to_csv
+}
+
+def run_transforms(f_path, transforms, dl):
+    """Apply the transforms of a dataset, in order, to a downloaded file. Returns the path of the transformed file.
+
+    Parameters:
+    f_path (str): The path of the downloaded file.
+    transforms (list): The transforms, as listed in datasets.json: "name" or "name:argument". Example: ['unzip', 'select_member'].
+    dl (dict): The download: file (output file name), ext (extension of the output file), encoding (encoding declared by the response, or None) and tmpdir (temporary directory of the download).
+
+    """
+    for t in transforms:
+        name, _, arg = t.partition(':')
+        f_path = transform_funs[name](f_path, arg if arg else None, dl)
+    if not os.path.isfile(f_path):
+        raise ValueError('Transforms did not produce a file: ' + ', '.join(transforms))
+    return f_path
+
 ## functions for web scraping
 
-def dl_file(url, dir_parent, dir_file, file, ext='.csv', user=False, verify=True, unzip=False, ab_json_to_csv=False, mb_json_to_csv=False):
+def dl_file(url, dir_parent, dir_file, file, ext='.csv', user=False, verify=True, transforms=None, uuid=None, retry=False):
     """Download file (generic).
 
-    Used to download most file types (when Selenium is not required). Some files are handled with file-specific code:
+    Used to download most file types (when Selenium is not required). Requests time out according to timeout. Returns 'Retry' if retry is True and the download failed with a transient error (timeout, connection error or a status code in retry_status); the failure is then not logged.
 
-    - unzip=True and file='13100781' has unique code.
-    - Each instance of ab_json_to_csv=True has unique code.
-    - Each instance of mb_json_to_csv=True has unique code.
+    Files that must be processed before upload (e.g., unzipped or converted to CSV) list the transforms to apply in datasets.json (see run_transforms).
 
     Parameters:
     url (str): URL to download file from.
@@ -253,112 +1390,108 @@ def dl_file(url, dir_parent, dir_file, file, ext='.csv', user=False, verify=True
     ext (str): Extension of the output file. Defaults to '.csv'.
     user (bool): Should the request impersonate a normal browser? Needed to access some data. Default: False.
     verify (bool): If False, requests will skip SSL verification. Default: True.
-    unzip (bool): If True, this file requires unzipping. Default: False.
-    ab_json_to_csv (bool): If True, this is an Alberta JSON file embedded in a webpage that should be converted to CSV. Default: False.
-    mb_json_to_csv (bool): If True, this is a Manitoba JSON file that that should be converted to CSV. Default: False.
+    transforms (list): Optional. Transforms applied, in order, to the file before upload (see run_transforms). Example: ['unzip', 'select_member'].
+    uuid (str): Optional. The UUID of the dataset, used to look up and save the HTTP validators of the last archived version when conditional_get is True.
+    retry (bool): Will the download be tried again after a transient failure (see run_downloads)? Default: False.
 
     """
-    global mode, download_log, success, failure, prefix_root
+    global mode, prefix_root, validators, conditional_get
 
     ## set names with timestamp and file ext
     name = file + '_' + get_datetime('America/Toronto').strftime('%Y-%m-%d_%H-%M')
     full_name = os.path.join(dir_parent, dir_file, name + ext)  
 
     ## download file
+    req = None
     try:
         ## some websites will reject the request unless you look like a normal web browser
-        ## user is True provides a normal-looking user agent string to bypass this
-        if user is True:
-            headers = {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.14; rv:66.0) Gecko/20100101 Firefox/66.0"}
-            req = requests.get(url, headers=headers, verify=verify)
-        else:
-            req = requests.get(url, verify=verify)
-
+        ## user is True uses a session with a normal-looking user agent string to bypass this
+        ## the body is streamed in chunks, so it is never held in memory (in test mode, it is read and discarded)
+        ## if conditional_get is True, only ask for the file if it changed since the last archived version
+        headers = {}
+        if conditional_get and uuid in validators:
+            if validators[uuid].get('etag'):
+                headers['If-None-Match'] = validators[uuid]['etag']
+            if validators[uuid].get('last_modified'):
+                headers['If-Modified-Since'] = validators[uuid]['last_modified']
+        ## time to first byte (from sending the request to receiving the headers, including the DNS lookup and the TCP and TLS handshakes if the session opens a new connection)
+        ## requests does not expose the DNS lookup or connect time separately (a reused connection has neither)
+        req = get_session(url, user=user is True).get(url, verify=verify, stream=True, headers=headers, timeout=timeout)
+        record(http_status=req.status_code, ttfb=req.elapsed.total_seconds())
+
+        ## check if file is unchanged since the last archived version
+        if req.status_code == 304:
+            log_result(full_name, 'Unchanged')
+            print(color('Not modified since last upload: ' + full_name, Colors.purple))
+        ## check if request failed with a transient error that should be retried
+        elif not req.ok and retry and req.status_code in retry_status:
+            print(color('Error downloading (HTTP ' + str(req.status_code) + '), will retry: ' + full_name, Colors.yellow))
+            record(status='Retry', file=full_name)
+            return 'Retry'
         ## check if request was successful
-        if not req.ok:
+        elif not req.ok:
             ## print failure
             print(background('Error downloading: ' + full_name, Colors.red))
-            failure+=1
             ## write failure to log message
-            download_log = download_log + 'Failure: ' + full_name + '\n'
+            log_result(full_name, 'Failure')
         ## successful request: if mode == test, print success and end
         elif mode == 'test':
+            ## read the body, so a truncated download fails and the connection can be reused
+            start = time.monotonic()
+            n_bytes = 0
+            for chunk in req.iter_content(chunk_size=chunk_size):
+                n_bytes += len(chunk)
+            record(bytes=n_bytes, transfer=time.monotonic() - start)
             ## print success and write to log
-            download_log = download_log + 'Success: ' + full_name + '\n'
+            log_result(full_name, 'Success')
             print(color('Test download successful: ' + full_name, Colors.green))
-            success+=1
         ## successful request: mode == prod, upload file
         else:
-            if unzip:
-                ## unzip data
-                tmpdir = tempfile.TemporaryDirectory()
-                zpath = os.path.join(tmpdir.name, 'zip_file.zip')
-                with open(zpath, mode='wb') as local_file:
-                    local_file.write(req.content)                        
-                with ZipFile(zpath, 'r') as zip_file:
-                    zip_file.extractall(tmpdir.name)
-                f_path = os.path.join(tmpdir.name, file + ext)
-                if file == '13100781':
-                    ## read CSV (informative columns only)
-                    data = pd.read_csv(f_path, usecols=['REF_DATE', 'Case identifier number', 'Case information', 'VALUE'])
-                    ## save original order of column values
-                    col_order = data['Case information'].unique()
-                    ## pivot long to wide
-                    data = data.pivot(index=['REF_DATE', 'Case identifier number'], columns='Case information', values='VALUE').reset_index()
-                    ## use original column order
-                    data = data[['REF_DATE', 'Case identifier number'] + col_order.tolist()]
-                    ## write CSV
-                    data.to_csv(f_path, index=None, quoting=csv.QUOTE_NONNUMERIC)
-            elif ab_json_to_csv:
-                ## for Alberta JSON data only: extract JSON from webpage, convert JSON to CSV and save as temporary file                    
-                tmpdir = tempfile.TemporaryDirectory()
-                f_path = os.path.join(tmpdir.name, file + ext)
-                data = re.search("(?<=\"data\"\:)\[\[.*\]\]", req.text).group(0)
-                if url == "https://www.alberta.ca/maps/covid-19-status-map.htm":
-                    data = BeautifulSoup(data, features="html.parser")
-                    data = data.get_text() # strip HTML tags
-                    ## this regex may need some tweaking if measures column changes in the future
-                    data = re.sub("<\\\/a><\\\/li><\\\/ul>", "", data) # strip remaining tags
-                    data = re.sub("(?<=\") ", "", data) # strip whitespace
-                    data = re.sub(" (?=\")", "", data) # strip whitespace
-                    data = pd.read_json(data).transpose()
-                    data = data.rename(columns={0: "", 1: "Region name", 2: "Measures", 3: "Active case rate (per 100,000 population)", 4: "Active cases", 5: "Population"})
-                elif url == "https://www.alberta.ca/schools/covid-19-school-status-map.htm":
-                    data = re.sub(',"container":.*', "", data) # strip remaining tags
-                    data = pd.read_json(data).transpose()
-                    data = data.rename(columns={0: "", 1: "Region name", 2: "School status", 3: "Schools details", 4: "num_ord"})
-                    data['num_ord'] = data['num_ord'].astype(str).astype(int) # convert to int
-                    data[''] = data[''].astype(str).astype(int) # convert to int
-                    data = data.sort_values(by=['num_ord', '']) # sort ascending by num_ord and first column (like CSV output on website)
-                data = data.to_csv(None, quoting=csv.QUOTE_ALL, index=False) # to match website output: quote all lines, don't terminate with new line
-                with open(f_path, 'w') as local_file:
-                    local_file.write(data[:-1])
-            elif mb_json_to_csv:
-                ## for Manitoba JSON data only: convert JSON to CSV and save as temporary file                    
-                tmpdir = tempfile.TemporaryDirectory()
-                f_path = os.path.join(tmpdir.name, file + ext)
-                data = pd.json_normalize(json.loads(req.content)['features'])
-                data.columns = data.columns.str.lstrip('attributes.') # strip prefix
-                ## replace timestamps with actual dates
-                if 'Date' in data.columns:
-                    data.Date = pd.to_datetime(data.Date / 1000, unit='s').dt.date
-                data.to_csv(f_path, index=None)
-            else:
-                ## all other data: write contents to temporary file
-                tmpdir = tempfile.TemporaryDirectory()
-                f_path = os.path.join(tmpdir.name, file + ext)
-                with open(f_path, mode='wb') as local_file:
-                    local_file.write(req.content)
-            ## upload file
+            ## stream contents to temporary file
+            tmpdir = tempfile.TemporaryDirectory()
+            f_path = os.path.join(tmpdir.name, file + ext)
+            start = time.monotonic()
+            record(bytes=write_response(req, f_path), transfer=time.monotonic() - start)
+            ## apply transforms (e.g., unzip or convert to CSV)
+            if transforms:
+                start = time.monotonic()
+                f_path = run_transforms(f_path, transforms, {'file': file, 'ext': ext, 'encoding': req.encoding, 'tmpdir': tmpdir.name})
+                record(transform=time.monotonic() - start)
+            ## upload file and save validators of the archived version for the next run
             s3_dir = os.path.join(dir_parent, dir_file)
-            upload_file(full_name, f_path, s3_dir=s3_dir, s3_prefix=prefix_root)
+            callback = None
+            if uuid:
+                headers = {
+                    'etag': req.headers.get('ETag'),
+                    'last_modified': req.headers.get('Last-Modified'),
+                    'content_length': req.headers.get('Content-Length')
+                }
+                def callback():
+                    with log_lock:
+                        validators[uuid] = headers
+            queue_upload(full_name, f_path, tmpdir, s3_dir=s3_dir, s3_prefix=prefix_root, callback=callback)
+    except retry_exceptions as e:
+        ## print failure
+        print(e)
+        record(error=type(e).__name__)
+        if retry:
+            print(color('Error downloading, will retry: ' + full_name, Colors.yellow))
+            record(status='Retry', file=full_name)
+            return 'Retry'
+        print(background('Error downloading: ' + full_name, Colors.red))
+        ## write failure to log message
+        log_result(full_name, 'Failure')
     except Exception as e:
         ## print failure
         print(e)
+        record(error=type(e).__name__)
         print(background('Error downloading: ' + full_name, Colors.red))
-        failure+=1
         ## write failure to log message
-        download_log = download_log + 'Failure: ' + full_name + '\n'
+        log_result(full_name, 'Failure')
+    finally:
+        ## release the connection back to the session's pool (only possible once the body is read, otherwise the connection is closed)
+        if req is not None:
+            req.close()
 
 def load_webdriver(tmpdir, user=False):
     """Load Chromium headless webdriver for Selenium.
@@ -368,6 +1501,8 @@ def load_webdriver(tmpdir, user=False):
     user (bool): Should the request impersonate a normal browser? Needed to access some data. Default: False.
     """
     global mode
+    from selenium import webdriver # requires ChromeDriver and Chromium/Chrome
+    from selenium.webdriver.chrome.options import Options
     
     options = Options()
     options.binary_location = os.environ['CHROME_BIN']
@@ -377,11 +1512,135 @@ def load_webdriver(tmpdir, user=False):
     prefs = {'download.default_directory' : tmpdir.name}
     options.add_experimental_option('prefs', prefs)
     if user:
-        options.add_argument("user-agent=Mozilla/5.0 (Macintosh; Intel Mac OS X 10.14; rv:66.0) Gecko/20100101 Firefox/66.0")
+        options.add_argument("user-agent=" + user_agent)
     driver = webdriver.Chrome(executable_path=os.environ['CHROMEDRIVER_BIN'], options=options)
     return driver
 
-def html_page(url, dir_parent, dir_file, file, ext='.html', user=False, js=False, wait=None):
+def get_webdriver(user=False):
+    """Get a headless browser from the pool, launching a new one if none are idle.
+
+    Browsers are kept in separate pools depending on whether they impersonate a normal browser (user), since the user agent is set at launch. Browsers must be returned with release_webdriver.
+
+    Parameters:
+    user (bool): Should the browser impersonate a normal browser? Default: False.
+
+    """
+    global webdriver_tmpdir
+    with webdriver_lock:
+        if webdrivers[user]:
+            driver = webdrivers[user].pop()
+            webdriver_pages[driver]+=1
+            return driver
+        if webdriver_tmpdir is None:
+            webdriver_tmpdir = tempfile.TemporaryDirectory()
+    ## launch new browser (outside the lock, as this is slow)
+    driver = load_webdriver(webdriver_tmpdir, user=user)
+    with webdriver_lock:
+        webdriver_pages[driver] = 1
+        webdriver_sizes[driver] = driver.get_window_size()
+    return driver
+
+def reset_webdriver(driver):
+    """Reset a headless browser to a clean state: no cookies, cache or storage, blank page and initial window size.
+
+    Parameters:
+    driver (WebDriver): The browser to reset.
+
+    """
+    url = urlparse(driver.current_url)
+    if url.scheme in ['http', 'https']:
+        ## clear storage (cookies, local storage, IndexedDB, etc.) of the current site and session storage of the tab
+        driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': url.scheme + '://' + url.netloc, 'storageTypes': 'all'})
+        driver.execute_script('window.sessionStorage.clear();')
+    driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+    driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+    driver.get('about:blank')
+    driver.set_window_size(webdriver_sizes[driver]['width'], webdriver_sizes[driver]['height'])
+
+def release_webdriver(driver, user=False, ok=True):
+    """Return a headless browser to the pool.
+
+    The browser is reset between datasets. It is quit instead if it failed (e.g., crashed), if it has loaded webdriver_max_pages pages, or if it cannot be reset.
+
+    Parameters:
+    driver (WebDriver): The browser, as returned by get_webdriver.
+    user (bool): The value of user passed to get_webdriver.
+    ok (bool): Did the browser finish loading the page without errors? Default: True.
+
+    """
+    if ok and webdriver_pages[driver] < webdriver_max_pages:
+        try:
+            reset_webdriver(driver)
+            with webdriver_lock:
+                webdrivers[user].append(driver)
+            return
+        except Exception as e:
+            print(e)
+    quit_webdriver(driver)
+
+def quit_webdriver(driver):
+    """Quit a headless browser and remove it from the pool.
+
+    Parameters:
+    driver (WebDriver): The browser to quit.
+
+    """
+    with webdriver_lock:
+        webdriver_pages.pop(driver, None)
+        webdriver_sizes.pop(driver, None)
+    try:
+        driver.quit()
+    except Exception as e:
+        print(e)
+
+def quit_webdrivers():
+    """Quit all idle headless browsers in the pool (i.e., at the end of the run)."""
+    with webdriver_lock:
+        drivers = webdrivers[True] + webdrivers[False]
+        webdrivers[True] = []
+        webdrivers[False] = []
+    for driver in drivers:
+        quit_webdriver(driver)
+
+def wait_for_page(driver, wait, ready_css=None, ready_stable=2, ready_network=False):
+    """Wait until the page loaded in a headless browser is ready, for at most wait seconds.
+
+    A page is ready when document.readyState is 'complete', the element given by ready_css (if any) is present and the page has stopped changing for ready_stable seconds. The page is considered to be changing if the number of elements or the length of its text changes or, if ready_network is True, if it requests new resources.
+
+    Returns True if the page was ready and False if the function timed out.
+
+    Parameters:
+    driver (WebDriver): The browser the page is loaded in.
+    wait (int): Maximum time in seconds to wait for the page.
+    ready_css (str): Optional. CSS selector of an element that must be present before the page is ready.
+    ready_stable (int): Time in seconds the page must stop changing before it is ready. Default: 2.
+    ready_network (bool): Must the page also stop requesting resources (e.g., data for a dashboard)? Default: False.
+
+    """
+    script = 'return [document.readyState, document.getElementsByTagName("*").length, document.body ? document.body.textContent.length : 0'
+    if ready_network:
+        script = script + ', performance.getEntriesByType("resource").length'
+    script = script + '];'
+    start = time.monotonic()
+    last_state = None
+    last_change = start
+    while True:
+        state = driver.execute_script(script)
+        now = time.monotonic()
+        ## restart stability window if the page changed
+        if state != last_state:
+            last_state = state
+            last_change = now
+        ready = state[0] == 'complete' and now - last_change >= ready_stable
+        if ready and ready_css:
+            ready = len(driver.find_elements_by_css_selector(ready_css)) > 0
+        if ready:
+            return True
+        if now - start >= wait:
+            return False
+        time.sleep(webdriver_poll)
+
+def html_page(url, dir_parent, dir_file, file, ext='.html', user=False, js=False, wait=None, ready_css=None, ready_stable=2, ready_network=False, uuid=None):
     """Save HTML of a webpage.
 
     Parameters:
@@ -391,66 +1650,81 @@ def html_page(url, dir_parent, dir_file, file, ext='.html', user=False, js=False
     ext (str): Extension of the output file. Defaults to '.html'.
     user (bool): Should the request impersonate a normal browser? Needed to access some data. Default: False.
     js (bool): Is the HTML source rendered by JavaScript?
-    wait (int): Used only if js = True. Time in seconds that the function should wait for the page to render. If the time is too short, the source code may not be captured.
+    wait (int): Used only if js = True. Maximum time in seconds that the function should wait for the page to render (see wait_for_page). If the time is too short, the source code may not be captured. Default: None (10 seconds).
+    ready_css (str): Used only if js = True. Optional. CSS selector of an element that must be present before the page is ready.
+    ready_stable (int): Used only if js = True. Time in seconds the page must stop changing before it is ready. Default: 2.
+    ready_network (bool): Used only if js = True. Must the page also stop requesting resources? Default: False.
+    uuid (str): Optional. The UUID of the dataset, recorded in the event of the download (see run_downloads).
 
     """
-    global mode, download_log, success, failure, prefix_root
+    global mode, prefix_root
     
     ## set names with timestamp and file ext
     name = file + '_' + get_datetime('America/Toronto').strftime('%Y-%m-%d_%H-%M')
     full_name = os.path.join(dir_parent, dir_file, name + ext)        
 
     ## download file
+    driver = None
+    driver_ok = False
     try:
         ## create temporary directory
         tmpdir = tempfile.TemporaryDirectory()
 
-        ## load webdriver
-        driver = load_webdriver(tmpdir, user=user)
+        ## get webdriver from the pool
+        start = time.monotonic()
+        driver = get_webdriver(user=user)
+        record(browser=time.monotonic() - start)
 
         ## load page
+        start = time.monotonic()
         driver.get(url)
+        record(load=time.monotonic() - start)
 
         ## save HTML of webpage
         f_path = os.path.join(tmpdir.name, file + ext)
         if js:
-            time.sleep(wait)
+            start = time.monotonic()
+            if not wait_for_page(driver, 10 if wait is None else wait, ready_css=ready_css, ready_stable=ready_stable, ready_network=ready_network):
+                print('Page not ready after waiting, saving anyway: ' + full_name)
+            record(ready=time.monotonic() - start)
             with open(f_path, 'w') as local_file:
                 local_file.write(driver.find_element_by_tag_name('html').get_attribute('innerHTML'))
         else:
             with open(f_path, 'w') as local_file:
                 local_file.write(driver.page_source)
+        record(bytes=os.path.getsize(f_path))
 
         ## verify download
         if not os.path.isfile(f_path):
             ## print failure
             print(background('Error downloading: ' + full_name, Colors.red))
-            failure+=1
             ## write failure to log message
-            download_log = download_log + 'Failure: ' + full_name + '\n'
+            log_result(full_name, 'Failure')
         ## successful request: if mode == test, print success and end
         elif mode == 'test':
             ## print success and write to log
-            download_log = download_log + 'Success: ' + full_name + '\n'
+            log_result(full_name, 'Success')
             print(color('Test download successful: ' + full_name, Colors.green))
-            success+=1
         ## successful request: mode == prod, prepare files for data upload
         else:
             ## upload file
             s3_dir = os.path.join(dir_parent, dir_file)
-            upload_file(full_name, f_path, s3_dir=s3_dir, s3_prefix=prefix_root)
+            queue_upload(full_name, f_path, tmpdir, s3_dir=s3_dir, s3_prefix=prefix_root)
 
-        ## quit webdriver
-        driver.quit()
+        ## webdriver finished without errors
+        driver_ok = True
     except Exception as e:
         ## print failure
         print(e)
         print(background('Error downloading: ' + full_name, Colors.red))
-        failure+=1
         ## write failure to log message
-        download_log = download_log + 'Failure: ' + full_name + '\n'
+        log_result(full_name, 'Failure')
+    finally:
+        ## return webdriver to the pool (or quit it, if it failed)
+        if driver is not None:
+            release_webdriver(driver, user=user, ok=driver_ok)
 
-def ss_page(url, dir_parent, dir_file, file, ext='.png', user=False, wait=5, width=None, height=None):
+def ss_page(url, dir_parent, dir_file, file, ext='.png', user=False, wait=5, width=None, height=None, ready_css=None, ready_stable=2, ready_network=False, uuid=None):
     """Take a screenshot of a webpage.
 
     By default, Selenium attempts to capture the entire page.
@@ -461,28 +1735,41 @@ def ss_page(url, dir_parent, dir_file, file, ext='.png', user=False, wait=5, wid
     dir_file (str): The file directory ('epidemiology-update').
     ext (str): Extension of the output file. Defaults to '.png'.
     user (bool): Should the request impersonate a normal browser? Needed to access some data. Default: False.
-    wait (int): Time in seconds that the function should wait. Should be > 0 to ensure the entire page is captured.
+    wait (int): Maximum time in seconds that the function should wait for the page to load (see wait_for_page). Should be > 0 to ensure the entire page is captured.
     width (int): Width of the output screenshot. Default: None. If not set, the function attempts to detect the maximum width.
     height (int): Height of the output screenshot. Default: None. If not set, the function attempts to detect the maximum height.
+    ready_css (str): Optional. CSS selector of an element that must be present before the page is ready.
+    ready_stable (int): Time in seconds the page must stop changing before it is ready. Default: 2.
+    ready_network (bool): Must the page also stop requesting resources? Default: False.
+    uuid (str): Optional. The UUID of the dataset, recorded in the event of the download (see run_downloads).
 
     """
-    global mode, download_log, success, failure, prefix_root
+    global mode, prefix_root
 
     ## set names with timestamp and file ext
     name = file + '_' + get_datetime('America/Toronto').strftime('%Y-%m-%d_%H-%M')
     full_name = os.path.join(dir_parent, dir_file, name + ext)        
 
     ## download file
+    driver = None
+    driver_ok = False
     try:
         ## create temporary directory
         tmpdir = tempfile.TemporaryDirectory()
 
-        ## load webdriver
-        driver = load_webdriver(tmpdir, user)
+        ## get webdriver from the pool
+        start = time.monotonic()
+        driver = get_webdriver(user=user)
+        record(browser=time.monotonic() - start)
 
-        ## load page and wait
+        ## load page and wait for it to be ready
+        start = time.monotonic()
         driver.get(url)
-        time.sleep(wait) # wait for page to load      
+        record(load=time.monotonic() - start)
+        start = time.monotonic()
+        if not wait_for_page(driver, wait, ready_css=ready_css, ready_stable=ready_stable, ready_network=ready_network):
+            print('Page not ready after waiting, capturing anyway: ' + full_name)
+        record(ready=time.monotonic() - start)
 
         ## take screenshot
         f_path = os.path.join(tmpdir.name, file + ext)
@@ -498,90 +1785,407 @@ def ss_page(url, dir_parent, dir_file, file, ext='.png', user=False, wait=5, wid
         ## take screenshot (and don't stop the script if it fails)
         try:
             driver.find_element_by_tag_name('body').screenshot(f_path) # remove scrollbar
+            if os.path.isfile(f_path):
+                record(bytes=os.path.getsize(f_path))
 
             ## verify screenshot
             if not os.path.isfile(f_path):
                 ## print failure
                 print(background('Error downloading: ' + full_name, Colors.red))
-                failure+=1
                 ## write failure to log message if mode == prod
-                if mode == 'prod':
-                    download_log = download_log + 'Failure: ' + full_name + '\n'
+                log_result(full_name, 'Failure', write_log=mode == 'prod')
             elif mode == 'test':
                 ## print success and write to log
-                download_log = download_log + 'Success: ' + full_name + '\n'
+                log_result(full_name, 'Success')
                 print(color('Test download successful: ' + full_name, Colors.green))
-                success+=1
             else:
                 ## upload file
                 s3_dir = os.path.join(dir_parent, dir_file)
-                upload_file(full_name, f_path, s3_dir=s3_dir, s3_prefix=prefix_root)
+                queue_upload(full_name, f_path, tmpdir, s3_dir=s3_dir, s3_prefix=prefix_root)
         except Exception as e:
             ## print exception
             print(e)
             ## print failure
             print(background('Error downloading: ' + full_name, Colors.red))
-            failure+=1
             ## write failure to log message if mode == prod
-            if mode == 'prod':
-                download_log = download_log + 'Failure: ' + full_name + '\n'
+            log_result(full_name, 'Failure', write_log=mode == 'prod')
 
-        ## quit webdriver
-        driver.quit()
+        ## webdriver finished without errors
+        driver_ok = True
     except Exception as e:
         ## print failure
         print(e)
         print(background('Error downloading: ' + full_name, Colors.red))
-        failure+=1
         ## write failure to log message if mode == prod
-        if mode == 'prod':
-            download_log = download_log + 'Failure: ' + full_name + '\n'
+        log_result(full_name, 'Failure', write_log=mode == 'prod')
+    finally:
+        ## return webdriver to the pool (or quit it, if it failed)
+        if driver is not None:
+            release_webdriver(driver, user=user, ok=driver_ok)
+
+## functions for running downloads
+
+def expected_durations(uuids, durations):
+    """Return the expected duration in seconds of each dataset, keyed by UUID. Datasets without a duration count as the median duration (1 second if no duration is known).
+
+    Parameters:
+    uuids (list): The UUIDs of the datasets.
+    durations (dict): The known durations, keyed by UUID (see dataset_durations).
+
+    """
+    known = sorted(durations[u] for u in uuids if u in durations)
+    default = known[len(known) // 2] if known else 1
+    return {u: durations.get(u, default) for u in uuids}
+
+def update_durations():
+    """Update the expected duration of each dataset downloaded in this run (see dataset_durations) from the events recorded by run_downloads.
+
+    The duration of a dataset in this run is the sum over all attempts (including retries and the upload, as in print_events_summary). It is averaged with the previous expected duration, weighted by duration_alpha, so one slow run does not reorder the next runs entirely.
+
+    """
+    totals = {}
+    for event in events:
+        if event.get('uuid') is not None:
+            totals[event['uuid']] = totals.get(event['uuid'], 0) + event['total']
+    for u, total in totals.items():
+        if u in dataset_durations:
+            total = duration_alpha * total + (1 - duration_alpha) * dataset_durations[u]
+        dataset_durations[u] = round(total, 3)
+
+def run_downloads(jobs, workers=1, host_workers=2, retries=0, host_rate=None, upload_workers=0, browser_workers=0):
+    """Run download jobs, optionally in parallel.
+
+    Jobs are started longest expected duration first (see dataset_durations), so the slowest datasets do not start last and hold up the end of the run; jobs without a known duration count as the median and otherwise keep the order given. A job is passed over (but not dropped) while its host already has host_workers downloads in progress or has exceeded its rate limit. The rate limit is a token bucket: each host may start up to host_burst downloads at once, then host_rate downloads per second. Results are recorded through log_result in the ledger of the run, which remains correct when workers > 1.
+
+    Downloads with dl_file (the only download function making plain, idempotent requests) that fail with a transient error are retried up to retries times. A failed job is put back at the end of the queue and may not start again before an exponential backoff with jitter (a random delay of up to retry_backoff * 2 ^ attempt seconds, at most retry_backoff_max seconds) has passed, so other jobs keep running in the meantime.
+
+    If upload_workers > 0, downloaded files are put in a bounded queue (see queue_upload) and uploaded by that many uploader threads, so uploads overlap with the following downloads. run_downloads returns once all files are uploaded.
+
+    If browser_workers > 0, jobs loading pages in a headless browser (see browser_funs) are run by a separate pool of browser_workers threads and the other jobs by workers threads, so slow browser jobs do not take up the workers of plain HTTP downloads (and the number of browsers running at once stays small).
+
+    Each attempt is recorded as an event (see record_event) with the name, UUID, host, download function and retry count of the job, its start time and total duration (including the upload, unless it is queued) and the fields recorded by the download function: result (status), HTTP status, time to first byte (including the DNS lookup and connection, if a new connection is opened), durations of the transfer and upload (and time spent in the upload queue), bytes downloaded and uploaded and, for pages loaded in a headless browser, the time taken to get a browser, load the page and wait for it to be ready.
+
+    Parameters:
+    jobs (list): List of (key, dl_fun, kwargs) tuples, where key is the name of the dataset, dl_fun is a download function (e.g., dl_file) and kwargs are the arguments passed to it (including url).
+    workers (int): Maximum number of downloads to run at once. Default: 1 (serial).
+    host_workers (int): Maximum number of downloads to run at once from a single host. Default: 2.
+    retries (int): Maximum number of times a download with dl_file is retried after a transient failure. Default: 0.
+    host_rate (float): Maximum number of downloads started per second from a single host. Default: None (no limit).
+    upload_workers (int): Number of threads uploading files in the background. Default: 0 (files are uploaded by the download functions).
+    browser_workers (int): Number of threads running the jobs loading pages in a headless browser. Default: 0 (all jobs are run by the same workers).
+
+    """
+    global upload_queue
+
+    ## start the jobs expected to take longest first (sorting is stable, so ties keep the order given)
+    expected = expected_durations([job[2].get('uuid') for job in jobs], dataset_durations)
+    jobs = sorted(jobs, key=lambda job: -expected[job[2].get('uuid')])
+
+    pending = [(job, 0, 0) for job in jobs] # (job, attempt, earliest start time)
+    active = {} # number of running downloads per host
+    buckets = {} # token bucket of each host: (tokens, time of last update)
+    cond = threading.Condition()
+
+    ## pool of a job: 'browser' or 'http' if browser jobs have their own pool, otherwise None (a single pool)
+    def pool_of(job):
+        if browser_workers <= 0:
+            return None
+        return 'browser' if job[1].__name__ in browser_funs else 'http'
+    running = {} # number of running downloads per pool
+
+    ## take a token from the bucket of a host: returns 0 if a token was taken, otherwise the time in seconds until one is available
+    def take_token(host, now):
+        if host_rate is None:
+            return 0
+        tokens, last = buckets.get(host, (host_burst, now))
+        tokens = min(host_burst, tokens + (now - last) * host_rate)
+        if tokens >= 1:
+            buckets[host] = (tokens - 1, now)
+            return 0
+        buckets[host] = (tokens, now)
+        return (1 - tokens) / host_rate
+
+    ## take the next job of a pool whose host is below the concurrency cap and rate limit and whose backoff has passed
+    def next_job(pool):
+        with cond:
+            ## a running job may still be put back to be retried
+            while any(pool_of(job) == pool for job, attempt, start in pending) or running.get(pool, 0) > 0:
+                now = time.monotonic()
+                delay = None # time until a job may be ready
+                for i, (job, attempt, start) in enumerate(pending):
+                    if pool_of(job) != pool:
+                        continue
+                    host = urlparse(job[2]['url']).netloc
+                    if active.get(host, 0) >= host_workers:
+                        continue
+                    wait = start - now if start > now else take_token(host, now)
+                    if wait == 0:
+                        active[host] = active.get(host, 0) + 1
+                        running[pool] = running.get(pool, 0) + 1
+                        pending.pop(i)
+                        return job, attempt, host
+                    delay = wait if delay is None else min(delay, wait)
+                cond.wait(delay)
+            return None, None, None
+
+    ## run the jobs of a pool until none are left
+    def worker(pool=None):
+        while True:
+            job, attempt, host = next_job(pool)
+            if job is None:
+                return
+            key, dl_fun, kwargs = job
+            print(key)
+            result = None
+            ## record the timing and metrics of this attempt (filled in by the download function through record)
+            event = {'key': key, 'uuid': kwargs.get('uuid'), 'dl_fun': dl_fun.__name__, 'host': host, 'retry': attempt, 'start': get_datetime('America/Toronto').isoformat()}
+            event_local.event = event
+            start = time.monotonic()
+            try:
+                if dl_fun is dl_file and attempt < retries:
+                    result = dl_fun(retry=True, **kwargs)
+                else:
+                    result = dl_fun(**kwargs)
+            except Exception as e:
+                ## download functions handle their own errors, so this should not happen
+                print(e)
+                print(background('Error running download: ' + key, Colors.red))
+            finally:
+                event_local.event = None
+                event['total'] = round(time.monotonic() - start, 3)
+                release_event(event)
+                with cond:
+                    active[host]-=1
+                    running[pool]-=1
+                    ## put job back at the end of the queue, to be retried after the backoff
+                    if result == 'Retry':
+                        backoff = random.uniform(0, min(retry_backoff_max, retry_backoff * 2 ** attempt))
+                        pending.append((job, attempt + 1, time.monotonic() + backoff))
+                        print('Retrying in ' + str(round(backoff)) + ' seconds: ' + key)
+                    cond.notify_all()
+
+    ## start uploaders
+    uploaders = []
+    if upload_workers > 0:
+        upload_queue = queue.Queue(maxsize=upload_queue_size)
+        uploaders = [threading.Thread(target=run_uploads, args=(upload_queue,)) for i in range(upload_workers)]
+        for thread in uploaders:
+            thread.start()
+
+    ## run serially in the main thread or start the worker threads of each pool
+    try:
+        if workers <= 1 and browser_workers <= 0:
+            worker()
+        else:
+            pools = {None: workers} if browser_workers <= 0 else {'http': max(workers, 1), 'browser': browser_workers}
+            threads = []
+            for pool, n in pools.items():
+                n_jobs = len([job for job, attempt, start in pending if pool_of(job) == pool])
+                threads += [threading.Thread(target=worker, args=(pool,)) for i in range(min(n, n_jobs))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        ## wait for the queued files to be uploaded
+        if uploaders:
+            for thread in uploaders:
+                upload_queue.put(None)
+            for thread in uploaders:
+                thread.join()
+            upload_queue = None
+
+## functions for sharded runs
+
+def shard_datasets(ds, i, n, durations=None, isolate_browser=False):
+    """Return the datasets of shard i of n (see set_mode).
+
+    Every dataset belongs to exactly one shard and the split only depends on the datasets (and durations), so shards running independently agree on it. By default, a dataset belongs to the shard given by a hash of its UUID. If durations are given, datasets are assigned longest first to the shard with the least expected time so far, so the shards take about as long as each other.
+
+    Parameters:
+    ds (list): The datasets (see registry.Dataset).
+    i (int): The shard, from 1 to n.
+    n (int): The number of shards.
+    durations (dict): Optional. The expected duration in seconds of each dataset, keyed by UUID (see dataset_durations). Datasets without a duration count as the median duration.
+    isolate_browser (bool): If True, shard 1 gets all datasets downloaded with a headless browser (see browser_funs) and the other datasets are split across the other shards. Default: False.
+
+    """
+    if isolate_browser and n > 1:
+        if i == 1:
+            return [d for d in ds if d.dl_fun in browser_funs]
+        ds = [d for d in ds if d.dl_fun not in browser_funs]
+        i, n = i - 1, n - 1
+    if durations is None:
+        return [d for d in ds if int(hashlib.sha256(d.uuid.encode()).hexdigest(), 16) % n == i - 1]
+    expected = expected_durations([d.uuid for d in ds], durations)
+    totals = [0] * n
+    shards = {}
+    for d in sorted(ds, key=lambda d: (-expected[d.uuid], d.uuid)):
+        j = totals.index(min(totals))
+        totals[j] += expected[d.uuid]
+        shards[d.uuid] = j
+    return [d for d in ds if shards[d.uuid] == i - 1]
+
+def shard_file(i, n):
+    """Return the name of the results of shard i of n of the current run (see run_id), in the root of the archive.
+
+    Parameters:
+    i (int): The shard, from 1 to n.
+    n (int): The number of shards.
+
+    """
+    return 'shard_' + run_id + '_' + str(i) + '-of-' + str(n) + '.json'
+
+def upload_shard(t, states, uuids, durations=None):
+    """Upload the results of this shard of the run to the root of the archive on Amazon S3, to be merged by merge_shards.
+
+    The results are the UUIDs of the datasets of the shard, how they were chosen (split: 'uuid' for the hash of their UUID, otherwise a hash of the durations used), the records of the ledger and the entries of the state files changed by this shard (shards start from the same state files, so only the changes are merged).
+
+    Parameters:
+    t (datetime): Date and time script began running (America/Toronto).
+    states (dict): The state files to merge, keyed by name. Example: {'manifest.json': manifest}.
+    uuids (list): The UUIDs of the datasets of this shard (see shard_datasets).
+    durations (dict): Optional. The durations the datasets were split by (see shard_datasets). Default: None (split by the hash of their UUID).
+
+    """
+    i, n = shard
+    split = 'uuid'
+    if durations is not None:
+        split = 'durations ' + hashlib.sha256(json.dumps(durations, sort_keys=True).encode()).hexdigest()[:16]
+    changes = {}
+    for f_name, state in states.items():
+        loaded = states_loaded.get(f_name, {})
+        changes[f_name] = {k: v for k, v in state.items() if loaded.get(k) != v}
+    results = {'t': t.isoformat(), 'run': run_id, 'shard': [i, n], 'split': split, 'uuids': uuids, 'records': ledger.records, 'states': changes}
+    upload_state(results, shard_file(i, n))
+
+def merge_shards(n, ds):
+    """Merge the results of the n shards of the current run (see run_id and upload_shard) into the ledger of this run and the state files.
+
+    A shard without results is recorded as a failure. So is every active dataset not run by exactly one shard, and a split of the datasets that differs between shards (e.g., a shard that could not load durations.json, or durations.json updated between the starts of two shards), so the email of the run reports it. Returns the date and time the earliest shard began running (the time of the run), the keys of the results merged and whether every state file was uploaded. The results may only be deleted (see delete_objects) once the state files and the log are uploaded, otherwise the merge cannot be run again.
+
+    Parameters:
+    n (int): The number of shards.
+    ds (list): The active datasets (see registry.Dataset).
+
+    """
+    global s3, prefix_root, ledger
+
+    ## merge ledgers and collect the changes to the state files
+    ledger = RunLedger()
+    t = None
+    changes = {}
+    keys = []
+    shards_of = {} # shards that ran each dataset, keyed by UUID
+    splits = {} # shards that split the datasets in each way (see upload_shard)
+    for i in range(1, n + 1):
+        results = load_state(shard_file(i, n))
+        if not results:
+            print(background('No results for shard ' + str(i) + ' of ' + str(n) + '.', Colors.red))
+            ledger.add({'status': 'Failure', 'file': 'shard ' + str(i) + ' of ' + str(n) + ' (no results)', 'logged': True, 'key': None, 'uuid': None, 'bytes': None, 'durations': {}})
+            continue
+        keys.append(prefix_root + '/' + shard_file(i, n))
+        for u in results['uuids']:
+            shards_of.setdefault(u, []).append(i)
+        splits.setdefault(results['split'], []).append(i)
+        for rec in results['records']:
+            ledger.add(rec)
+        t_shard = datetime.fromisoformat(results['t'])
+        if t is None or t_shard < t:
+            t = t_shard
+        for f_name, change in results['states'].items():
+            changes.setdefault(f_name, []).append(change)
+
+    ## check that the shards split the datasets the same way and that every active dataset was run by exactly one shard
+    if len(splits) > 1:
+        problem = 'shards split the datasets differently: ' + '; '.join('shards ' + ', '.join(str(i) for i in v) + ' by ' + k for k, v in splits.items())
+        print(background('The ' + problem + '.', Colors.red))
+        ledger.add({'status': 'Failure', 'file': 'sharded run (' + problem + ')', 'logged': True, 'key': None, 'uuid': None, 'bytes': None, 'durations': {}})
+    for d in ds:
+        d_shards = shards_of.get(d.uuid, [])
+        if len(d_shards) != 1:
+            problem = 'not run by any shard' if len(d_shards) == 0 else 'run by shards ' + ', '.join(str(i) for i in d_shards)
+            print(background('Dataset ' + problem + ': ' + d.id_name, Colors.red))
+            ledger.add({'status': 'Failure', 'file': d.id_name + ' (' + problem + ')', 'logged': True, 'key': d.id_name, 'uuid': d.uuid, 'bytes': None, 'durations': {}})
+
+    ## apply the changes of every shard to the state files
+    uploaded = True
+    for f_name, change in changes.items():
+        state = load_state(f_name)
+        for c in change:
+            state.update(c)
+        if not upload_state(state, f_name):
+            uploaded = False
+            ledger.add({'status': 'Failure', 'file': f_name + ' (merged state file not uploaded)', 'logged': True, 'key': None, 'uuid': None, 'bytes': None, 'durations': {}})
+    if t is None:
+        t = get_datetime('America/Toronto')
+    return t, keys, uploaded
 
 ## indexing
 
-def create_index(url_base, inventory):
+def create_index(url_base, inventory, previous=None):
     """ Create an index of files in datasets.json stored in the S3 bucket.
     
+    If the previous index is given, it is updated incrementally rather than created from scratch: only files not in the previous index are added, and true dates and MD5 duplicates are recalculated only from the earliest date of each dataset with new files (see update_index()).
+    
     Parameters:
     url_base (str): The base URL to the S3 bucket, used to construct file URLs.
     inventory (str): The path to the S3 Inventory data folder.
+    previous: Optional. The previous index returned by load_index(). If None, the index is created from scratch.
     
     """
     global s3, prefix_root
+    import pandas as pd
     
-    ## load datasets.json
-    with open('datasets.json') as json_file:
-        datasets = json.load(json_file)
-    
-    ## convert datasets into single dictionary
-    ds = {} # create empty dictionary
-    for a in datasets: # active and inactive
-        for d in datasets[a]:
-            for i in range(len(datasets[a][d])):
-                ds[datasets[a][d][i]['uuid']] = datasets[a][d][i]
+    ## get directory of each dataset in datasets.json (active and inactive)
+    ds_keys = set((d.dir_parent, d.dir_file) for d in registry.load_registry('datasets.json'))
     
     ## retrieve latest S3 inventory
     inv_dir = s3.objects.filter(Prefix=inventory)
-    inv_files = list(inv_dir)
-    # remove directories
-    inv_files = [inv for inv in inv_files if inv.get()['ContentType'] != 'application/octet-stream']
+    # keep only inventory data files (removes directories), using the metadata returned by the listing
+    inv_files = [inv for inv in inv_dir if inv.key.endswith('.csv.gz')]
     # get latest file
-    get_last_modified = lambda inv: int(inv.get()['LastModified'].strftime('%s'))
-    inv_file = [inv for inv in sorted(inv_files, key=get_last_modified)][-1]
+    inv_file = sorted(inv_files, key=lambda inv: inv.last_modified)[-1]
     inv = inv_file.get()['Body']
     
-    ## process S3 inventory file
+    ## read S3 inventory file
     inv = pd.read_csv(inv, compression='gzip', header=None, sep=',', quotechar='"')
     # assign column names
     inv = inv.rename(columns={0: 'bucket', 1: 'file_path', 2: 'file_size', 3: 'file_md5'})
     # drop unneeded column
     inv = inv.drop('bucket', axis=1)
-    # calculate other columns
-    inv['dir_parent'] = inv['file_path'].apply(lambda x: os.path.dirname(x).split('/')[1:-1])
-    inv['dir_parent'] = inv['dir_parent'].apply(lambda x: '/'.join(x))
-    inv['dir_file'] = inv['file_path'].apply(lambda x: os.path.dirname(x).split('/')[-1])
-    inv['file_name'] = inv['file_path'].apply(lambda x: os.path.basename(x))
-    inv['file_timestamp'] = inv['file_name'].str.extract('(?<=_)(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}).*$', expand=True)
+    
+    ## update previous index, if available
+    if previous is not None and previous['file_timestamp'].notna().any():
+        return update_index(previous, inv, url_base, ds_keys)
+    
+    ## process S3 inventory file
+    index = process_inventory(inv, url_base)
+    
+    ## calculate true dates and md5 duplicates
+    index = index_datasets(index, ds_keys)
+    
+    ## return index
+    return(index)
+
+def process_inventory(inv, url_base):
+    """ Calculate the columns of the file index from the file paths in the S3 inventory.
+    
+    Directories, log files and supplementary files are removed. True dates and MD5 duplicates are initialized but not calculated (see index_dataset()).
+    
+    Parameters:
+    inv: The S3 inventory, with columns file_path, file_size and file_md5.
+    url_base (str): The base URL to the S3 bucket, used to construct file URLs.
+    
+    """
+    global prefix_root
+    import pandas as pd
+    import numpy as np
+    
+    # calculate other columns: parse file paths in a single pass
+    inv = pd.concat([inv, inv['file_path'].str.extract(inv_path_regex)], axis=1)
+    inv['dir_parent'] = inv['dir_parent'].fillna('')
+    inv['dir_file'] = inv['dir_file'].fillna('')
     inv['file_date'] = pd.to_datetime(inv['file_timestamp'], format='%Y-%m-%d_%H-%M').dt.date
     inv['file_url'] = url_base + inv['file_path']
     # initialize other columns
@@ -593,50 +2197,227 @@ def create_index(url_base, inventory):
     inv = inv[inv['dir_file'] != 'supplementary'] # remove supplementary files
     # keep only necessary columns and reorder
     index = inv[['dir_parent', 'dir_file', 'file_name', 'file_timestamp', 'file_date', 'file_date_true', 'file_size', 'file_md5', 'file_md5_duplicate', 'file_url']]
+    # store directories as categories (many files per directory)
+    index = index.astype({'dir_parent': 'category', 'dir_file': 'category'})
     # sort index
     index = index.sort_values(by=['dir_parent', 'dir_file', 'file_timestamp'])
     
-    ## calculate true dates and md5 duplicates - loop through each dataset
-    for key in ds:
-        d_p = ds[key]['dir_parent']
-        d_f = ds[key]['dir_file']
-        # get data
-        d = index[(index['dir_parent'] == d_p) & (index['dir_file'] == d_f)]
-        # check if there are multiple hashes on the first date of data
-        d_first_date = d[d['file_date'] == d['file_date'].min()].drop_duplicates(['file_md5'])
-        if (len(d_first_date) > 1):
-            # if there multiple hashes on the first date, assume the earliest file is actually from the previous date
-            d.loc[d['file_name'] == d_first_date.iloc[0]['file_name'], 'file_date_true'] = d.loc[d['file_name'] == d_first_date.iloc[0]['file_name'], 'file_date'] - timedelta(days=1)
-        # generate list of all possible dates: from first true date to last true date
-        d_dates_seq = pd.date_range(d['file_date_true'].min(), d['file_date'].max()).tolist()
-        # generate list of all dates in the dataset
-        d_dates = d['file_date_true'].unique().tolist()
-        # are any expected dates are missing?
-        d_dates_missing = np.setdiff1d(d_dates_seq, d_dates)
-        if (len(d_dates_missing) > 0):
-            # if there are any missing dates, check if there are multiple hashes in the following day
-            for j in d_dates_missing:
-                d_dates_next = d[d['file_date_true'] == j + timedelta(days=1)].drop_duplicates(['file_md5'])
-                if len(d_dates_next) > 1:
-                    # if there are more than 0 or 1 hashes on the previous date, assume the earliest hash actually corresponds to the missing day
-                    d.loc[d['file_name'] == d_dates_next.iloc[0]['file_name'], 'file_date_true'] = d.loc[d['file_name'] == d_dates_next.iloc[0]['file_name'], 'file_date_true'] - timedelta(days=1)
-        # using true date, keep only the final hash of each date ('definitive file' for that date)
-        d = d.drop_duplicates(['file_date_true'], keep='last')
-        # using hash, mark duplicates appearing after the first instance (e.g., duplicate hashes of Friday value for weekend versions of files updated only on weekdays)
-        d['file_md5_duplicate'] = d['file_md5'].duplicated()
-        # mark duplicates using 1 and 0 rather than True and False
-        d['file_md5_duplicate'] = np.where(d['file_md5_duplicate']==True, 1, 0)
-        # save modified index
-        index[(index['dir_parent'] == d_p) & (index['dir_file'] == d_f)] = d
+    ## return index
+    return(index)
+
+def index_datasets(index, keys):
+    """ Calculate true dates and MD5 duplicates for the files of the given datasets.
+    
+    Only the definitive file for each true date (the final file of that date) is kept: the other files of these datasets are left as blank rows. file_md5_duplicate is set to 1 if the definitive file is identical to an earlier definitive file of the same dataset and 0 otherwise.
+    
+    Parameters:
+    index: The index, sorted by dir_parent, dir_file and file_timestamp.
+    keys: The (dir_parent, dir_file) of each dataset to process.
+    
+    """
+    import pandas as pd
+    import numpy as np
+    
+    print('Calculating true dates and MD5 duplicates...')
+    
+    ## get data
+    in_ds = pd.MultiIndex.from_frame(index[['dir_parent', 'dir_file']]).isin(list(keys))
+    d = index[in_ds]
+    ds_key = pd.Categorical(d['dir_parent'].astype(str) + '/' + d['dir_file'].astype(str)) # directory of each dataset
+    d_date = pd.to_datetime(d['file_date'])
+    d_md5 = d['file_md5']
+    by_ds = lambda x: x.groupby(ds_key, observed=True)
+    
+    ## check if there are multiple hashes on the first date of data
+    d_first_date = d_date == by_ds(d_date).transform('min')
+    d_first_md5 = by_ds(d_md5.where(d_first_date)).transform('nunique')
+    # if there multiple hashes on the first date, assume the earliest file is actually from the previous date
+    d_shift = d_first_date & (by_ds(d_first_date).cumsum() == 1) & (d_first_md5 > 1)
+    
+    ## check if there are multiple hashes on the day following a missing date
+    # the first file of a date follows a missing date if the previous date with files is more than one day earlier
+    d_after_missing = by_ds(d_date).diff() > pd.Timedelta(days=1)
+    d_date_md5 = d_md5.groupby([ds_key, d_date], observed=True).transform('nunique')
+    # if so, assume the earliest hash actually corresponds to the missing day
+    d_shift = d_shift | (d_after_missing & (d_date_md5 > 1))
+    d_date_true = d_date - pd.to_timedelta(d_shift.astype(int), unit='D')
+    
+    ## using true date, keep only the final hash of each date ('definitive file' for that date)
+    d_def = ~pd.DataFrame({'ds_key': ds_key, 'file_date_true': d_date_true}).duplicated(keep='last').to_numpy()
+    # using hash, mark duplicates appearing after the first instance (e.g., duplicate hashes of Friday value for weekend versions of files updated only on weekdays)
+    d_dup = pd.DataFrame({'ds_key': ds_key, 'file_md5': d_md5})[d_def].duplicated()
+    
+    ## save modified index
+    index = index.copy()
+    index.loc[in_ds, 'file_date_true'] = d_date_true.dt.date.to_numpy()
+    # mark duplicates using 1 and 0 rather than True and False
+    index.loc[d.index[d_def], 'file_md5_duplicate'] = np.where(d_dup, 1, 0)
+    index.loc[d.index[~d_def], :] = np.nan
+    
+    ## return index
+    return(index)
+
+def update_index(previous, inv, url_base, keys):
+    """ Update the previous index with the files in the S3 inventory that it does not contain.
+    
+    Files are matched by path, so files uploaded late (with a timestamp earlier than files already in the previous index) are picked up too. The files of a dataset before the earliest date with a new file are left as they are: their true dates only depend on the files of the same date and the following date. From that date onwards, the true dates and MD5 duplicates are recalculated using the files of that dataset in the S3 inventory and the definitive file of the preceding date. Superseded files are blank rows in the previous index, so their paths are not known: the files not found in the previous index between two of its files are compared with the number of blank rows between them, and the dataset is recalculated from the date of the first file where they differ. Datasets absent from the previous index are indexed in full. The result is the same as creating the index from scratch.
+    
+    Parameters:
+    previous: The previous index returned by load_index().
+    inv: The S3 inventory, with columns file_path, file_size and file_md5.
+    url_base (str): The base URL to the S3 bucket, used to construct file URLs.
+    keys: The (dir_parent, dir_file) of each dataset in datasets.json.
+    
+    """
+    import pandas as pd
+    import numpy as np
+    
+    ## files of the S3 inventory not in the previous index (including superseded files, which are blank rows in the previous index)
+    previous = previous.reset_index(drop=True)
+    prev = previous[previous['file_name'].notna()] # the index of prev is the position of each row in previous
+    inv_url = url_base + inv['file_path']
+    cand = process_inventory(inv[~inv_url.isin(prev['file_url'])], url_base)
+    # files of the previous index no longer in the S3 inventory
+    gone = prev[~prev['file_url'].isin(inv_url)]
+    
+    ## dates and timestamps of files, for comparisons (files without a timestamp sort last in their dataset, see process_inventory)
+    def file_dates(x):
+        return x['file_date'].where(x['file_date'].notna(), date.max).to_numpy()
+    def file_timestamps(x):
+        return x['file_timestamp'].astype(object).where(x['file_timestamp'].notna(), '~').to_numpy() # '~' sorts after any timestamp
+    
+    ## locate each dataset in the previous index: rows from the row after the last row of the preceding dataset to its last row
+    prev_rows = prev.groupby(['dir_parent', 'dir_file'], sort=False).indices # rows of prev of each dataset
+    prev_pos = prev.index.to_numpy()
+    prev_dates = file_dates(prev)
+    prev_ts = file_timestamps(prev)
+    # blank rows before each file of the previous index (the rows after the last file of the preceding dataset belong to the next dataset)
+    prev_blanks = np.diff(np.concatenate([[-1], prev_pos])) - 1
+    prev_keys = sorted(prev_rows)
+    prev_last_pos = {k: prev_pos[prev_rows[k][-1]] for k in prev_keys}
+    def seg_start(k):
+        i = bisect.bisect_left(prev_keys, k)
+        return prev_last_pos[prev_keys[i - 1]] + 1 if i > 0 else 0
+    
+    ## find the date from which each dataset with new (or removed) files is recalculated (date.min: indexed in full)
+    starts = {}
+    cand_dates = file_dates(cand)
+    cand_ts = file_timestamps(cand)
+    for k, c in cand.groupby(['dir_parent', 'dir_file'], observed=True).indices.items():
+        if k not in prev_rows:
+            starts[k] = date.min
+            continue
+        if k not in keys:
+            # datasets not in datasets.json have no blank rows
+            starts[k] = min(cand_dates[c])
+            continue
+        g = prev_rows[k]
+        ts = prev_ts[g]
+        dates = prev_dates[g]
+        blanks = prev_blanks[g]
+        c_ts = cand_ts[c]
+        # usually, the files before the last file of the previous index are its blank rows and the others are new
+        c_new = c_ts > ts[-1]
+        if (~c_new).sum() == blanks.sum():
+            if c_new.any():
+                starts[k] = dates[-1]
+            continue
+        # otherwise, compare the files between each two files of the previous index with its blank rows
+        counts = np.bincount(np.searchsorted(ts, c_ts, side='right'), minlength=len(ts) + 1)
+        j = np.flatnonzero(counts != np.append(blanks, 0))[0]
+        starts[k] = dates[j - 1] if j > 0 else min(min(cand_dates[c]), dates[0])
+    for k, g in gone.groupby(['dir_parent', 'dir_file']):
+        starts[k] = min(starts.get(k, date.max), min(file_dates(g)))
+    if len(starts) == 0:
+        print('No new files to index.')
+        return(previous)
+    upd_keys = sorted(starts)
+    
+    ## read the files of each updated dataset from the date it is recalculated from
+    inv_cols = inv['file_path'].str.extract(inv_path_regex)
+    inv_upd = pd.MultiIndex.from_frame(inv_cols[['dir_parent', 'dir_file']].fillna('')).isin(upd_keys)
+    inv_upd &= (inv_cols['file_timestamp'] >= min(starts.values()).strftime('%Y-%m-%d')) | inv_cols['file_timestamp'].isna()
+    tail = process_inventory(inv[inv_upd], url_base)
+    tail_start = np.array([starts[k] for k in zip(tail['dir_parent'], tail['dir_file'])], dtype=object)
+    tail = tail[file_dates(tail) >= tail_start]
+    # definitive files before that date, the last of which is used as context
+    prev_upd = prev[pd.MultiIndex.from_frame(prev[['dir_parent', 'dir_file']]).isin(upd_keys)]
+    prev_start = np.array([starts[k] for k in zip(prev_upd['dir_parent'], prev_upd['dir_file'])], dtype=object)
+    prev_head = prev_upd[file_dates(prev_upd) < prev_start]
+    context = prev_head.groupby(['dir_parent', 'dir_file']).tail(1)
+    context = context[pd.MultiIndex.from_frame(context[['dir_parent', 'dir_file']]).isin([k for k in upd_keys if k in keys])]
+    
+    ## recalculate true dates and md5 duplicates (datasets in datasets.json)
+    tail_key = list(zip(tail['dir_parent'], tail['dir_file']))
+    tail_in_ds = np.array([k in keys for k in tail_key], dtype=bool)
+    d = pd.concat([context.assign(context=True), tail[tail_in_ds].assign(context=False)], ignore_index=True)
+    d = d.sort_values(by=['dir_parent', 'dir_file', 'file_timestamp'])
+    d_context = d.pop('context').to_numpy()
+    d_key = [k for k, c in zip(zip(d['dir_parent'], d['dir_file']), d_context) if not c]
+    d = index_datasets(d, [k for k in upd_keys if k in keys])
+    # mark duplicates, including of definitive files before that date
+    d_dup = pd.MultiIndex.from_frame(d[['dir_parent', 'dir_file', 'file_md5']]).isin(pd.MultiIndex.from_frame(prev_head[['dir_parent', 'dir_file', 'file_md5']]))
+    d.loc[d_dup, 'file_md5_duplicate'] = 1
+    
+    ## locate updated rows of each dataset in the previous index
+    edits = {} # (first row replaced, row after last row replaced)
+    head_last_pos = prev_head.reset_index().groupby(['dir_parent', 'dir_file'])['index'].max()
+    for k in upd_keys:
+        if k in prev_last_pos:
+            stop = prev_last_pos[k] + 1
+            # replace the rows of the previous index after the last definitive file before that date
+            start = head_last_pos[k] + 1 if k in head_last_pos else seg_start(k)
+        else:
+            start = stop = seg_start(k)
+        edits[k] = (start, stop)
         # print progress
-        print(d_p + '/' + d_f)
+        print(k[0] + '/' + k[1])
+    
+    ## splice updated rows into the previous index
+    # datasets not in datasets.json: add files as they are
+    rows = pd.concat([d[~d_context], tail[~tail_in_ds]])
+    rows_key = d_key + [k for k, i in zip(tail_key, tail_in_ds) if not i]
+    rows_order = sorted(range(len(rows_key)), key=lambda i: rows_key[i])
+    rows = rows.iloc[rows_order]
+    rows_pos = [edits[rows_key[i]][0] - 0.5 for i in rows_order] # just before the first row replaced
+    keep = np.ones(len(previous), dtype=bool)
+    for start, stop in edits.values():
+        keep[start:stop] = False
+    index = pd.concat([previous[keep], rows[previous.columns]], ignore_index=True)
+    pos = np.concatenate([np.flatnonzero(keep), rows_pos])
+    index = index.iloc[np.argsort(pos, kind='stable')].reset_index(drop=True)
     
     ## return index
     return(index)
 
+def load_index():
+    """ Load the file index previously uploaded to Amazon S3 by write_index().
+    
+    Returns None if the file index could not be loaded.
+    
+    """
+    global s3, prefix_root
+    import pandas as pd
+    
+    print('Loading previous file index...')
+    try:
+        tmpdir = tempfile.TemporaryDirectory()
+        file_index = os.path.join(tmpdir.name, 'file_index.csv')
+        s3.download_file(Filename=file_index, Key=prefix_root + '/file_index.csv')
+        index = pd.read_csv(file_index, dtype={'dir_parent': str, 'dir_file': str, 'file_timestamp': str})
+        for col in ['file_date', 'file_date_true']:
+            index[col] = pd.to_datetime(index[col]).dt.date
+        print(color('Previous file index loaded!', Colors.green))
+    except:
+        print(background('Previous file index could not be loaded, creating file index from scratch.', Colors.red))
+        index = None
+    return index
+
 def write_index(index):
     """ Upload file index to Amazon S3.
     
+    The index is uploaded as a CSV file (file_index.csv) and as a columnar Parquet file (file_index.parquet, see index_columnar()).
+    
     Parameters:
     index: The index returned by create_index().
     
@@ -644,9 +2425,9 @@ def write_index(index):
     global prefix_root
     
     print('Writing file index...')
+    tmpdir = tempfile.TemporaryDirectory()
     try:
         ## write file index temporarily and upload
-        tmpdir = tempfile.TemporaryDirectory()
         file_index = os.path.join(tmpdir.name, 'file_index.csv')
         index.to_csv(file_index, index=False)
         s3.upload_file(Filename=file_index, Key=prefix_root + '/file_index.csv')
@@ -654,3 +2435,30 @@ def write_index(index):
         print(color('File index upload successful!', Colors.green))
     except:
         print(background('File index upload failed!', Colors.red))
+    try:
+        ## write columnar file index temporarily and upload
+        file_index = os.path.join(tmpdir.name, 'file_index.parquet')
+        index_columnar(index).to_parquet(file_index, index=False, row_group_size=index_row_group_size)
+        s3.upload_file(Filename=file_index, Key=prefix_root + '/file_index.parquet')
+        ## report success
+        print(color('Columnar file index upload successful!', Colors.green))
+    except:
+        print(background('Columnar file index upload failed!', Colors.red))
+
+def index_columnar(index):
+    """ Prepare the file index for columnar storage.
+    
+    Blank rows (superseded files) are removed and the rows are sorted by dir_parent, dir_file and file_timestamp, so the files of each dataset are stored together. Directories are stored as dictionary-encoded strings, dates as dates and MD5 duplicates as nullable integers. A single dataset can then be read with a filter, e.g., pd.read_parquet(f, filters=[('dir_parent', '==', 'ab'), ('dir_file', '==', 'cases')]).
+    
+    Parameters:
+    index: The index returned by create_index().
+    
+    """
+    import pandas as pd
+    
+    index = index[index['file_name'].notna()]
+    index = index.sort_values(by=['dir_parent', 'dir_file', 'file_timestamp'])
+    index = index.astype({'dir_parent': 'category', 'dir_file': 'category', 'file_size': 'int64', 'file_md5_duplicate': 'Int8'})
+    for col in ['file_date', 'file_date_true']:
+        index[col] = pd.to_datetime(index[col]).dt.date # stored as date32
+    return index
@@ -0,0 +1,81 @@
+# bench_startup.py: Measure the startup time of the scripts of Covid19CanadaArchive #
+# https://github.com/ccodwg/Covid19CanadaArchive #
+# Maintainer: Jean-Paul R. Soucy #
+
+# usage
+## python bench_startup.py
+## optional: -n <number of runs of each statement> (default: 10)
+## optional: --importtime (also print the slowest imports of archivist.py, from python -X importtime)
+
+# import modules
+
+## core utilities
+import sys
+import os
+import time
+import subprocess
+import statistics
+import argparse
+
+# define global variables
+
+## statements timed in a fresh interpreter: (name, statement)
+## each interpreter starts cold (no modules imported), like a short test-mode run in CI
+statements = [
+    ('python', 'pass'),
+    ('import archivist', 'import archivist'),
+    ('import archivist + registry', 'import archivist, registry; registry.load_registry()'),
+    ('import archivist + pandas', 'import archivist, pandas'),
+    ('import lookup', 'import lookup')
+]
+
+# define functions
+
+def time_statement(stmt, n):
+    """ Time a statement in n fresh interpreters and return the times in seconds.
+
+    Parameters:
+    stmt (str): The statement.
+    n (int): Number of runs.
+
+    """
+    times = []
+    for i in range(n):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', stmt], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(time.perf_counter() - start)
+    return times
+
+def print_importtime(n=15):
+    """ Print the slowest imports of archivist.py (cumulative time, from python -X importtime).
+
+    Parameters:
+    n (int): Number of imports to print.
+
+    """
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import archivist'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    imports = []
+    for line in res.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            fields = line[len('import time:'):].split('|')
+            if fields[1].strip().isdigit():
+                imports.append((int(fields[1]), fields[2].rstrip()))
+    print('Slowest imports (cumulative):')
+    for us, name in sorted(imports, reverse=True)[:n]:
+        print('{:8.1f} ms  {}'.format(us / 1000, name))
+
+# run as a script
+if __name__ == '__main__':
+
+    ## parse arguments
+    parser = argparse.ArgumentParser(description='Measure the startup time of the scripts of Covid19CanadaArchive.')
+    parser.add_argument('-n', type=int, default=10, help='number of runs of each statement')
+    parser.add_argument('--importtime', action='store_true', help='also print the slowest imports of archivist.py')
+    args = parser.parse_args()
+
+    ## time statements
+    for name, stmt in statements:
+        times = time_statement(stmt, args.n)
+        print('{:30} median {:6.0f} ms  min {:6.0f} ms'.format(name, statistics.median(times) * 1000, min(times) * 1000))
+    if args.importtime:
+        print_importtime()
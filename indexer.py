@@ -5,12 +5,16 @@
 # import modules
 print('Importing modules...')
 
+## core utilities
+import os
+
 ## archivist.py
 import archivist
 
 # list of environmental variables used in this script (through functions in archivist.py)
 ## AWS_ID: environmental variable of AWS ID
 ## AWS_KEY: environmental variable of AWS key
+## INDEX_FULL: optional, if "True", the index is created from scratch rather than updated from the previous index (default: "False")
 
 # load AWS credentials
 archivist.aws_id = os.environ['AWS_ID']
@@ -22,10 +26,17 @@ archivist.s3 = archivist.access_s3(bucket='data.opencovid.ca')
 ## set S3 path prefix for achived files
 archivist.prefix_root = 'archive'
 
+# load previous index (unless the index is created from scratch)
+if os.environ.get('INDEX_FULL', 'False') == 'True':
+  previous = None
+else:
+  previous = archivist.load_index()
+
 # create index
 index = archivist.create_index(
   url_base='https://s3.us-east-2.amazonaws.com/data.opencovid.ca/',
-  inventory='/data.opencovid.ca/archive/data/')
+  inventory='/data.opencovid.ca/archive/data/',
+  previous=previous)
 
 # write index to CSV
 archivist.write_index(index)
@@ -0,0 +1,50 @@
+# logs.py: Read and compact the log of Covid19CanadaArchive #
+# https://github.com/ccodwg/Covid19CanadaArchive #
+# Maintainer: Jean-Paul R. Soucy #
+
+# usage
+## python logs.py read [--start <date>] [--end <date>]
+## python logs.py compact [--before <date>]
+## read: print the full log, stitched together from log.txt and the log segments of each run (see archivist.log_storage)
+## compact: append the log segments to log.txt and remove them (optional: only the segments of dates before --before)
+## dates are YYYY-MM-DD
+
+# import modules
+
+## core utilities
+import sys
+import os
+import argparse
+
+## archivist.py
+import archivist
+
+# list of environmental variables used in this script (through functions in archivist.py)
+## AWS_ID: environmental variable of AWS ID
+## AWS_KEY: environmental variable of AWS key
+
+# parse arguments
+parser = argparse.ArgumentParser(description='Read and compact the log of Covid19CanadaArchive.')
+parser.add_argument('fun', choices=['read', 'compact'])
+parser.add_argument('--start', help='read: first date of the log segments to include (YYYY-MM-DD), log.txt is then left out')
+parser.add_argument('--end', help='read: last date of the log segments to include (YYYY-MM-DD)')
+parser.add_argument('--before', help='compact: only compact the log segments of dates before this date (YYYY-MM-DD)')
+args = parser.parse_args()
+
+# load AWS credentials
+archivist.aws_id = os.environ['AWS_ID']
+archivist.aws_key = os.environ['AWS_KEY']
+
+# access S3 (messages go to stderr, so the log can be piped)
+stdout = sys.stdout
+sys.stdout = sys.stderr
+archivist.s3 = archivist.access_s3(bucket='data.opencovid.ca')
+archivist.prefix_root = 'archive'
+
+# read or compact log
+if args.fun == 'read':
+    log = archivist.read_log(start=args.start, end=args.end)
+    sys.stdout = stdout
+    print(log)
+else:
+    archivist.compact_log(before=args.before)
@@ -0,0 +1,188 @@
+# lookup.py: Look up files in the index of Covid19CanadaArchive #
+# https://github.com/ccodwg/Covid19CanadaArchive #
+# Maintainer: Jean-Paul R. Soucy #
+
+# usage (as a script)
+## python lookup.py latest <dataset>
+## python lookup.py on_date <dataset> <date>
+## python lookup.py range <dataset> <start> <end>
+## <dataset> is a UUID from datasets.json or a directory (dir_parent/dir_file), dates are YYYY-MM-DD
+## optional: --index <path or URL to file_index.csv or file_index.parquet> (default: index_url)
+
+# usage (as a module)
+## import lookup
+## lookup.load_lookup()
+## lookup.on_date('59da1de8-3b4e-429a-9e18-b67ba3834002', '2021-01-05')
+
+# import modules
+
+## core utilities
+import sys
+import csv
+import bisect
+import argparse
+from datetime import date
+
+## other utilities
+import pandas as pd # better data processing
+
+## registry.py
+import registry
+
+# define global variables
+
+## default location of the file index
+index_url = 'https://data.opencovid.ca.s3.amazonaws.com/archive/file_index.csv'
+
+## files of each dataset, keyed by directory (dir_parent, dir_file): (sorted list of true dates, list of rows)
+files = {}
+## directory of each dataset in datasets.json, keyed by UUID
+uuids = {}
+## columns of the file index, as arrays (rows are positions in these arrays)
+columns = {}
+
+# define functions
+
+def load_lookup(index=index_url, datasets='datasets.json'):
+    """ Load the file index and precompute the lookup of files by dataset and true date.
+
+    Only the definitive file of each true date is kept (for datasets not in datasets.json, the final file of each date).
+
+    Parameters:
+    index (str): Path or URL to the file index written by archivist.write_index(), either file_index.csv or file_index.parquet.
+    datasets (str): Path to datasets.json, used to look up datasets by UUID.
+
+    """
+    global files, uuids, columns
+
+    ## load datasets.json (active and inactive)
+    uuids = {d.uuid: (d.dir_parent, d.dir_file) for d in registry.load_registry(datasets)}
+
+    ## load file index
+    if index.endswith('.parquet'):
+        idx = pd.read_parquet(index)
+    else:
+        idx = pd.read_csv(index, dtype={'dir_parent': str, 'dir_file': str, 'file_date': str, 'file_date_true': str})
+    idx = idx[idx['file_name'].notna()] # remove blank rows (superseded files)
+    idx = idx.astype({'file_date': str, 'file_date_true': str})
+    # keep the final file of each true date
+    idx = idx.sort_values(by=['dir_parent', 'dir_file', 'file_date_true', 'file_timestamp'])
+    idx = idx.drop_duplicates(['dir_parent', 'dir_file', 'file_date_true'], keep='last')
+    columns = {col: idx[col].to_numpy() for col in idx.columns}
+
+    ## precompute sorted true dates and rows of each dataset
+    files = {}
+    keys = list(zip(columns['dir_parent'], columns['dir_file']))
+    i = 0
+    while i < len(keys):
+        j = i
+        while j < len(keys) and keys[j] == keys[i]:
+            j += 1
+        files[keys[i]] = (list(columns['file_date_true'][i:j]), list(range(i, j)))
+        i = j
+    print('Loaded ' + str(len(idx)) + ' files from ' + str(len(files)) + ' datasets.', file=sys.stderr)
+
+def get_files(dataset):
+    """ Get the true dates and rows of a dataset (see files).
+
+    Parameters:
+    dataset (str): UUID of the dataset in datasets.json or its directory (dir_parent/dir_file).
+
+    """
+    if dataset in uuids:
+        key = uuids[dataset]
+    else:
+        key = tuple(dataset.rsplit('/', 1))
+    return files.get(key, ([], []))
+
+def get_row(i):
+    """ Get a row of the file index as a dictionary.
+
+    Parameters:
+    i (int): Position of the row.
+
+    """
+    return {col: columns[col][i] for col in columns}
+
+def as_date(d):
+    """ Convert a date to a YYYY-MM-DD string, the format of true dates in the file index.
+
+    Parameters:
+    d: A date (datetime.date) or a YYYY-MM-DD string.
+
+    """
+    if isinstance(d, date):
+        return d.strftime('%Y-%m-%d')
+    return str(d)
+
+def latest(dataset):
+    """ Return the latest file of a dataset (as a dictionary), or None if it has no files.
+
+    Parameters:
+    dataset (str): UUID of the dataset in datasets.json or its directory (dir_parent/dir_file).
+
+    """
+    dates, rows = get_files(dataset)
+    if len(rows) == 0:
+        return None
+    return get_row(rows[-1])
+
+def on_date(dataset, d):
+    """ Return the file of a dataset for a true date (as a dictionary), or None if there is no file for that date.
+
+    Parameters:
+    dataset (str): UUID of the dataset in datasets.json or its directory (dir_parent/dir_file).
+    d: The date (datetime.date or YYYY-MM-DD string).
+
+    """
+    dates, rows = get_files(dataset)
+    d = as_date(d)
+    i = bisect.bisect_left(dates, d)
+    if i < len(dates) and dates[i] == d:
+        return get_row(rows[i])
+    return None
+
+def in_range(dataset, start, end):
+    """ Return the files of a dataset for true dates from start to end, inclusive (as a list of dictionaries).
+
+    Parameters:
+    dataset (str): UUID of the dataset in datasets.json or its directory (dir_parent/dir_file).
+    start: The first date (datetime.date or YYYY-MM-DD string).
+    end: The last date (datetime.date or YYYY-MM-DD string).
+
+    """
+    dates, rows = get_files(dataset)
+    i = bisect.bisect_left(dates, as_date(start))
+    j = bisect.bisect_right(dates, as_date(end))
+    return [get_row(r) for r in rows[i:j]]
+
+# run as a script
+if __name__ == '__main__':
+
+    ## parse arguments
+    parser = argparse.ArgumentParser(description='Look up files in the index of Covid19CanadaArchive.')
+    parser.add_argument('fun', choices=['latest', 'on_date', 'range'])
+    parser.add_argument('dataset', help='UUID of the dataset in datasets.json or its directory (dir_parent/dir_file)')
+    parser.add_argument('dates', nargs='*', help='YYYY-MM-DD: one date for on_date, start and end for range')
+    parser.add_argument('--index', default=index_url, help='path or URL to file_index.csv or file_index.parquet')
+    args = parser.parse_args()
+    n_dates = {'latest': 0, 'on_date': 1, 'range': 2}[args.fun]
+    if len(args.dates) != n_dates:
+        parser.error(args.fun + ' takes ' + str(n_dates) + ' date(s)')
+
+    ## look up files
+    load_lookup(args.index)
+    if args.fun == 'latest':
+        res = [latest(args.dataset)]
+    elif args.fun == 'on_date':
+        res = [on_date(args.dataset, args.dates[0])]
+    else:
+        res = in_range(args.dataset, args.dates[0], args.dates[1])
+    res = [r for r in res if r is not None]
+
+    ## print files as CSV
+    writer = csv.DictWriter(sys.stdout, fieldnames=list(columns))
+    writer.writeheader()
+    writer.writerows(res)
+    if len(res) == 0:
+        sys.exit(1)
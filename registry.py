@@ -0,0 +1,306 @@
+# registry.py: Registry of the datasets in datasets.json for Covid19CanadaArchive #
+# https://github.com/ccodwg/Covid19CanadaArchive #
+# Maintainer: Jean-Paul R. Soucy #
+
+# usage
+## import registry
+## reg = registry.load_registry() # all datasets (active and inactive), validated
+## for ds in registry.active(reg): ...
+## url = ds.url if ds.url is not None else ds.url_fun() # dynamic URLs are computed by url_fun_python
+
+# import modules
+
+## core utilities
+import sys
+import os
+import json
+import hashlib
+import marshal
+import pickle
+
+# define global variables
+
+## fields every dataset must have (url or url_fun_python is also required, see validate)
+fields = ['id_name', 'uuid', 'active', 'dir_parent', 'dir_file', 'file_name', 'file_ext', 'dl_fun', 'args']
+
+## download functions (in archivist.py) a dataset may use
+dl_funs = ['dl_file', 'html_page', 'ss_page']
+
+## arguments a dataset may pass to its download function: (type, download functions accepting the argument)
+## values are strings in datasets.json: "True"/"False" for bool, e.g. "10" for int
+arg_types = {
+    'user': (bool, ['dl_file', 'html_page', 'ss_page']),
+    'verify': (bool, ['dl_file']),
+    'js': (bool, ['html_page']),
+    'wait': (int, ['html_page', 'ss_page']),
+    'width': (int, ['ss_page']),
+    'height': (int, ['ss_page']),
+    'ready_css': (str, ['html_page', 'ss_page']),
+    'ready_stable': (int, ['html_page', 'ss_page']),
+    'ready_network': (bool, ['html_page', 'ss_page'])
+}
+
+## transforms (in archivist.py) a dataset downloaded with dl_file may apply, in order, to the file before upload
+## listed in datasets.json as "name" or "name:argument": allowed arguments of each transform ('' for none, None for any)
+transforms = {
+    'unzip': [''], # extract a zip archive
+    'select_member': None, # select a file extracted from an archive (default: the output file name)
+    'pivot': None, # pivot a CSV file from long to wide: "pivot:<index columns, separated by commas>|<columns column>|<values column>"
+    'json_to_csv': ['ab_status_map', 'ab_school_map', 'mb_features'] # convert JSON to CSV
+}
+
+## directory in which compiled registries are cached, keyed by a hash of datasets.json and of this file (None: do not cache on disk)
+## the hash of this file is part of the key, so a registry validated by older rules (e.g., arg_types) is not reused
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__')
+with open(os.path.abspath(__file__), 'rb') as source_file:
+    source_hash = hashlib.sha256(source_file.read()).digest()
+
+## compiled registries loaded by this process, keyed by the same hash
+registries = {}
+
+# define classes
+
+class Dataset:
+    """ A dataset in datasets.json, with its arguments converted to their types (see arg_types).
+
+    Attributes:
+    id_name (str): Name of the dataset (unique).
+    uuid (str): UUID of the dataset (unique).
+    active (bool): Is the dataset active?
+    section (str): Section of datasets.json the dataset is listed in ('active' or 'inactive').
+    group (str): Group of datasets.json the dataset is listed in. Example: 'can'.
+    dir_parent (str): The parent directory. Example: 'other/can'.
+    dir_file (str): The file directory. Example: 'epidemiology-update'.
+    file_name (str): Output file name (excluding extension).
+    file_ext (str): Extension of the output file (excluding the period).
+    dl_fun (str): Name of the download function in archivist.py.
+    args (dict): Arguments passed to the download function, converted to their types.
+    url (str): URL of the dataset, or None if it is computed by url_fun_python.
+    url_fun_python (str): Python code computing the URL as the global variable url_current, or None.
+    transforms (list): Transforms applied to the downloaded file before upload (see transforms), in order. Empty for most datasets.
+
+    """
+    __slots__ = ['id_name', 'uuid', 'active', 'section', 'group', 'dir_parent', 'dir_file', 'file_name', 'file_ext', 'dl_fun', 'args', 'url', 'url_fun_python', 'url_code', 'transforms']
+
+    def __init__(self, entry, section, group):
+        self.id_name = entry['id_name']
+        self.uuid = entry['uuid']
+        self.active = entry['active'] == 'True'
+        self.section = section
+        self.group = group
+        self.dir_parent = entry['dir_parent']
+        self.dir_file = entry['dir_file']
+        self.file_name = entry['file_name']
+        self.file_ext = entry['file_ext']
+        self.dl_fun = entry['dl_fun']
+        self.args = {arg: convert_arg(arg, val) for arg, val in entry['args'].items()}
+        self.url = entry.get('url')
+        self.url_fun_python = entry.get('url_fun_python')
+        self.transforms = entry.get('transforms', [])
+        ## compile the code once, so it is only run (not parsed) when the URL is needed
+        self.url_code = None
+        if self.url_fun_python is not None:
+            self.url_code = compile(self.url_fun_python, '<url_fun_python: ' + self.id_name + '>', 'exec')
+
+    def url_fun(self):
+        """ Compute the URL of a dataset with a dynamic URL by running its url_fun_python code.
+
+        The code runs in its own namespace, so the global variable url_current it sets does not leak into the caller.
+
+        """
+        namespace = {}
+        exec(self.url_code, namespace)
+        return namespace['url_current']
+
+    def kwargs(self, url):
+        """ Return the arguments of the download function of the dataset.
+
+        Parameters:
+        url (str): URL of the dataset (url, or the result of url_fun for a dataset with a dynamic URL).
+
+        """
+        kwargs = dict(
+            url = url,
+            dir_parent = self.dir_parent,
+            dir_file = self.dir_file,
+            file = self.file_name,
+            ext = '' if url == '' else '.' + self.file_ext,
+            uuid = self.uuid,
+            **self.args
+        )
+        if self.transforms:
+            kwargs['transforms'] = self.transforms
+        return kwargs
+
+    ## code objects cannot be pickled, so they are cached with marshal
+    def __getstate__(self):
+        state = {k: getattr(self, k) for k in self.__slots__}
+        if self.url_code is not None:
+            state['url_code'] = marshal.dumps(self.url_code)
+        return state
+
+    def __setstate__(self, state):
+        for k in self.__slots__:
+            setattr(self, k, state[k])
+        if self.url_code is not None:
+            self.url_code = marshal.loads(self.url_code)
+
+# define functions
+
+def convert_arg(arg, val):
+    """ Convert an argument from its string value in datasets.json to its type (see arg_types).
+
+    Parameters:
+    arg (str): Name of the argument.
+    val (str): Value of the argument in datasets.json.
+
+    """
+    arg_type = arg_types[arg][0]
+    if arg_type is bool:
+        if val not in ['True', 'False']:
+            raise ValueError('expected "True" or "False", got ' + repr(val))
+        return val == 'True'
+    return arg_type(val)
+
+def validate(entry, section, group):
+    """ Check an entry of datasets.json and return a list of its problems (empty if it is valid).
+
+    Parameters:
+    entry (dict): The entry.
+    section (str): Section of datasets.json the entry is listed in ('active' or 'inactive').
+    group (str): Group of datasets.json the entry is listed in.
+
+    """
+    errors = []
+    missing = [f for f in fields if f not in entry]
+    if missing:
+        errors.append('missing field(s): ' + ', '.join(missing))
+    for f in fields + ['url', 'url_fun_python']:
+        if f in entry and f != 'args' and not isinstance(entry[f], str):
+            errors.append(f + ' must be a string')
+    if entry.get('active') not in ['True', 'False']:
+        errors.append('active must be "True" or "False"')
+    elif (entry['active'] == 'True') != (section == 'active'):
+        errors.append('active is ' + entry['active'] + ' but the dataset is listed in ' + section)
+    if 'dl_fun' in entry and entry['dl_fun'] not in dl_funs:
+        errors.append('unknown dl_fun: ' + str(entry['dl_fun']))
+    if ('url' in entry) == ('url_fun_python' in entry):
+        errors.append('exactly one of url and url_fun_python is required')
+    if isinstance(entry.get('url_fun_python'), str):
+        try:
+            compile(entry['url_fun_python'], '<url_fun_python>', 'exec')
+        except SyntaxError as e:
+            errors.append('url_fun_python does not compile: ' + str(e))
+        if 'url_current' not in entry['url_fun_python']:
+            errors.append('url_fun_python must set url_current')
+    if not isinstance(entry.get('transforms', []), list) or not all(isinstance(t, str) for t in entry.get('transforms', [])):
+        errors.append('transforms must be a list of strings')
+    else:
+        if entry.get('transforms') and entry.get('dl_fun') in dl_funs and entry['dl_fun'] != 'dl_file':
+            errors.append('transforms are not applied by ' + entry['dl_fun'])
+        for t in entry.get('transforms', []):
+            name, _, arg = t.partition(':')
+            if name not in transforms:
+                errors.append('unknown transform: ' + name)
+            elif transforms[name] is not None and arg not in transforms[name]:
+                errors.append('invalid argument of transform ' + name + ': ' + repr(arg))
+            elif name == 'pivot' and (arg.count('|') != 2 or '' in arg.split('|')):
+                errors.append('pivot must be "pivot:<index columns>|<columns column>|<values column>"')
+    if not isinstance(entry.get('args', {}), dict):
+        errors.append('args must be an object')
+    else:
+        for arg, val in entry.get('args', {}).items():
+            if arg not in arg_types:
+                errors.append('unknown arg: ' + arg)
+                continue
+            if entry.get('dl_fun') in dl_funs and entry['dl_fun'] not in arg_types[arg][1]:
+                errors.append('arg ' + arg + ' is not accepted by ' + entry['dl_fun'])
+            try:
+                convert_arg(arg, val)
+            except (ValueError, TypeError) as e:
+                errors.append('invalid value of arg ' + arg + ': ' + str(e))
+    return errors
+
+def build_registry(datasets):
+    """ Validate the contents of datasets.json and convert them into a list of Dataset records.
+
+    All entries are checked before any error is raised, so every problem is reported at once.
+
+    Parameters:
+    datasets (dict): The contents of datasets.json.
+
+    """
+    errors = []
+    reg = []
+    uuids = set()
+    id_names = set()
+    for section in datasets: # active and inactive
+        for group in datasets[section]:
+            for i, entry in enumerate(datasets[section][group]):
+                name = section + '/' + group + '[' + str(i) + '] (' + str(entry.get('id_name')) + ')'
+                entry_errors = validate(entry, section, group)
+                ## identifiers must be unique
+                if entry.get('uuid') in uuids:
+                    entry_errors.append('duplicate uuid: ' + str(entry['uuid']))
+                if entry.get('id_name') in id_names:
+                    entry_errors.append('duplicate id_name: ' + str(entry['id_name']))
+                uuids.add(entry.get('uuid'))
+                id_names.add(entry.get('id_name'))
+                if entry_errors:
+                    errors.extend([name + ': ' + e for e in entry_errors])
+                else:
+                    reg.append(Dataset(entry, section, group))
+    if errors:
+        raise ValueError('Invalid datasets.json:\n' + '\n'.join(errors))
+    return reg
+
+def load_registry(path='datasets.json'):
+    """ Load, validate and compile the datasets in datasets.json.
+
+    The compiled registry is cached in memory and in cache_dir, keyed by a hash of datasets.json and of registry.py, so it is only rebuilt when either changes. Older registries in cache_dir are removed. Raises ValueError (listing every problem) if datasets.json is invalid.
+
+    Parameters:
+    path (str): Path to datasets.json. Default: 'datasets.json'.
+
+    """
+    with open(path, 'rb') as json_file:
+        raw = json_file.read()
+    key = hashlib.sha256(raw + source_hash).hexdigest()[:16]
+    if key in registries:
+        return registries[key]
+
+    ## load compiled registry from the cache (code objects are specific to the Python version)
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, 'registry.' + key + '.' + sys.implementation.cache_tag + '.pickle')
+        try:
+            with open(cache_file, 'rb') as local_file:
+                registries[key] = pickle.load(local_file)
+            return registries[key]
+        except Exception:
+            pass
+
+    ## build registry and cache it, replacing older registries (the cache is optional, so failures are ignored)
+    registries[key] = build_registry(json.loads(raw))
+    if cache_file:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file + '.' + str(os.getpid())
+            with open(tmp_file, 'wb') as local_file:
+                pickle.dump(registries[key], local_file)
+            os.replace(tmp_file, cache_file)
+            for f in os.listdir(cache_dir):
+                if f.startswith('registry.') and f.endswith('.pickle') and f != os.path.basename(cache_file):
+                    os.remove(os.path.join(cache_dir, f))
+        except Exception:
+            pass
+    return registries[key]
+
+def active(reg):
+    """ Return the active datasets (listed in the active section of datasets.json) of a registry.
+
+    Parameters:
+    reg (list): The registry returned by load_registry.
+
+    """
+    return [ds for ds in reg if ds.section == 'active']
@@ -0,0 +1,52 @@
+# test_converters.py: Golden-file tests of the JSON to CSV conversions of archivist.py #
+# https://github.com/ccodwg/Covid19CanadaArchive #
+# Maintainer: Jean-Paul R. Soucy #
+
+## each dataset converted by json_to_csv has a recorded input in golden ('<dir_parent>_<dir_file>.html' or '.json')
+## and the CSV produced from it by the pandas/BeautifulSoup converters the current ones replaced ('<dir_parent>_<dir_file>.csv');
+## the converted file must match that CSV byte for byte, since archived files are compared against earlier versions
+
+# import modules
+import os
+import sys
+import pytest
+
+## run from anywhere: archivist.py and datasets.json are in the parent directory
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+import archivist
+import registry
+
+## directory of the recorded inputs and expected CSVs
+golden_dir = os.path.join(repo_dir, 'tests', 'golden')
+
+## datasets converted by json_to_csv
+converted = [ds for ds in registry.load_registry(os.path.join(repo_dir, 'datasets.json'))
+             if any(t.partition(':')[0] == 'json_to_csv' for t in ds.transforms)]
+
+def golden_name(ds):
+    """Return the name of the golden files of a dataset (excluding extension).
+
+    Parameters:
+    ds (registry.Dataset): The dataset.
+
+    """
+    return ds.dir_parent.replace('/', '_') + '_' + ds.dir_file
+
+def test_all_converted_datasets_have_golden_files():
+    for ds in converted:
+        name = golden_name(ds)
+        assert os.path.isfile(os.path.join(golden_dir, name + '.csv')), 'No expected CSV for ' + ds.id_name
+        assert any(os.path.isfile(os.path.join(golden_dir, name + e)) for e in ['.html', '.json']), 'No recorded input for ' + ds.id_name
+
+@pytest.mark.parametrize('ds', converted, ids=golden_name)
+def test_json_to_csv_matches_golden(ds, tmp_path):
+    name = golden_name(ds)
+    f_path = [os.path.join(golden_dir, name + e) for e in ['.html', '.json'] if os.path.isfile(os.path.join(golden_dir, name + e))][0]
+    dl = {'file': ds.file_name, 'ext': '.' + ds.file_ext, 'encoding': 'utf-8', 'tmpdir': str(tmp_path)}
+    out = archivist.run_transforms(f_path, ds.transforms, dl)
+    with open(out, 'rb') as local_file:
+        data = local_file.read()
+    with open(os.path.join(golden_dir, name + '.csv'), 'rb') as local_file:
+        expected = local_file.read()
+    assert data == expected
@@ -0,0 +1,184 @@
+# test_index.py: Tests of the file index created by archivist.py #
+# https://github.com/ccodwg/Covid19CanadaArchive #
+# Maintainer: Jean-Paul R. Soucy #
+
+## the file index must be the same as the one created by the original loop over datasets (index_per_dataset),
+## and updating the previous index must give the same result as creating the index from scratch
+
+# import modules
+import os
+import sys
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+import pytest
+
+## run from anywhere: archivist.py is in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import archivist
+
+## base URL of the files
+url_base = 'https://data.opencovid.ca/'
+
+## datasets in datasets.json (other/zz/unlisted is not, so its files are indexed as they are)
+keys = [('ab', 'cases'), ('ab', 'schools'), ('other/mb', 'testing')]
+
+## files of each dataset: (timestamp, md5)
+files = {
+    # multiple hashes on the first date, a missing date followed by a date with multiple hashes and duplicate hashes
+    ('ab', 'cases'): [
+        ('2021-01-01_10-00', 'a1'), ('2021-01-01_18-00', 'a2'),
+        ('2021-01-02_10-00', 'a2'),
+        ('2021-01-03_09-00', 'a2'),
+        ('2021-01-05_08-00', 'a3'), ('2021-01-05_20-00', 'a4'),
+        ('2021-01-06_07-00', 'a4'), ('2021-01-06_21-00', 'a4'),
+        ('2021-01-07_09-00', 'a1'),
+        ('2021-01-08_09-00', 'a5'), ('2021-01-08_12-00', 'a6'), ('2021-01-08_23-00', 'a5')
+    ],
+    # a missing date followed by a date with a single hash, and two missing dates
+    ('ab', 'schools'): [
+        ('2021-01-02_23-00', 'b1'),
+        ('2021-01-03_23-00', 'b2'),
+        ('2021-01-05_23-00', 'b2'), ('2021-01-05_23-30', 'b2'),
+        ('2021-01-08_06-00', 'b3'), ('2021-01-08_23-00', 'b1'),
+        ('2021-01-09_23-00', 'b4')
+    ],
+    # multiple files with the same hash on the first date
+    ('other/mb', 'testing'): [
+        ('2021-01-03_01-00', 'c1'), ('2021-01-03_13-00', 'c1'),
+        ('2021-01-04_01-00', 'c2'), ('2021-01-04_13-00', 'c3'),
+        ('2021-01-06_01-00', 'c3'), ('2021-01-06_13-00', 'c4'), ('2021-01-06_14-00', 'c1')
+    ],
+    ('other/zz', 'unlisted'): [
+        ('2021-01-01_00-00', 'z1'), ('2021-01-01_12-00', 'z2'), ('2021-01-04_00-00', 'z1')
+    ]
+}
+
+def make_inventory(until=None, skip=(), extra=()):
+    """Return a synthetic S3 inventory (columns file_path, file_size and file_md5), including directories, log files and supplementary files.
+
+    Parameters:
+    until (str): Optional. Only include files with a timestamp up to this one.
+    skip (tuple): Optional. Paths of files to leave out (e.g., files uploaded late).
+    extra (tuple): Optional. Paths of files to add (e.g., files later removed), with the MD5 'e0'.
+
+    """
+    rows = [('archive/', 0, 'd41d8cd98f00b204e9800998ecf8427e'), ('archive/log.txt', 10, 'f0'), ('archive/ab/supplementary/notes_2021-01-02_00-00.pdf', 10, 'f1')]
+    for (d_p, d_f), d_files in files.items():
+        rows.append(('archive/' + d_p + '/' + d_f + '/', 0, 'd41d8cd98f00b204e9800998ecf8427e'))
+        for i, (ts, md5) in enumerate(d_files):
+            if until is None or ts <= until:
+                rows.append(('archive/' + d_p + '/' + d_f + '/' + d_f + '_' + ts + '.csv', 100 + i, md5))
+    rows = [r for r in rows if r[0] not in skip] + [(p, 1, 'e0') for p in extra]
+    ## the inventory is not sorted
+    rows = [rows[i] for i in np.random.RandomState(1).permutation(len(rows))]
+    return pd.DataFrame(rows, columns=['file_path', 'file_size', 'file_md5'])
+
+def index_per_dataset(inv, keys):
+    """Create the file index by looping over the datasets, as create_index did before index_datasets.
+
+    Parameters:
+    inv: The S3 inventory.
+    keys: The (dir_parent, dir_file) of each dataset.
+
+    """
+    inv = inv.copy()
+    inv['dir_parent'] = inv['file_path'].apply(lambda x: '/'.join(os.path.dirname(x).split('/')[1:-1]))
+    inv['dir_file'] = inv['file_path'].apply(lambda x: os.path.dirname(x).split('/')[-1])
+    inv['file_name'] = inv['file_path'].apply(lambda x: os.path.basename(x))
+    inv['file_timestamp'] = inv['file_name'].str.extract(r'(?<=_)(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}).*$', expand=True)
+    inv['file_date'] = pd.to_datetime(inv['file_timestamp'], format='%Y-%m-%d_%H-%M').dt.date
+    inv['file_url'] = url_base + inv['file_path']
+    inv['file_date_true'] = inv['file_date']
+    inv['file_md5_duplicate'] = np.nan
+    inv = inv[inv['file_md5'] != 'd41d8cd98f00b204e9800998ecf8427e']
+    inv = inv[inv['dir_file'] != 'archive']
+    inv = inv[inv['dir_file'] != 'supplementary']
+    index = inv[['dir_parent', 'dir_file', 'file_name', 'file_timestamp', 'file_date', 'file_date_true', 'file_size', 'file_md5', 'file_md5_duplicate', 'file_url']]
+    index = index.sort_values(by=['dir_parent', 'dir_file', 'file_timestamp'])
+    for d_p, d_f in keys:
+        d = index[(index['dir_parent'] == d_p) & (index['dir_file'] == d_f)]
+        d_first_date = d[d['file_date'] == d['file_date'].min()].drop_duplicates(['file_md5'])
+        if len(d_first_date) > 1:
+            d.loc[d['file_name'] == d_first_date.iloc[0]['file_name'], 'file_date_true'] = d.loc[d['file_name'] == d_first_date.iloc[0]['file_name'], 'file_date'] - timedelta(days=1)
+        # compare dates as dates (pandas >= 2 no longer treats a Timestamp as equal to the same date)
+        d_dates_seq = pd.date_range(d['file_date_true'].min(), d['file_date'].max()).date.tolist()
+        d_dates = d['file_date_true'].unique().tolist()
+        d_dates_missing = np.setdiff1d(d_dates_seq, d_dates)
+        for j in d_dates_missing:
+            d_dates_next = d[d['file_date_true'] == j + timedelta(days=1)].drop_duplicates(['file_md5'])
+            if len(d_dates_next) > 1:
+                d.loc[d['file_name'] == d_dates_next.iloc[0]['file_name'], 'file_date_true'] = d.loc[d['file_name'] == d_dates_next.iloc[0]['file_name'], 'file_date_true'] - timedelta(days=1)
+        d = d.drop_duplicates(['file_date_true'], keep='last')
+        d['file_md5_duplicate'] = np.where(d['file_md5'].duplicated(), 1, 0)
+        index[(index['dir_parent'] == d_p) & (index['dir_file'] == d_f)] = d
+    return index
+
+def create_index(inv):
+    """Create the file index from scratch, as create_index does.
+
+    Parameters:
+    inv: The S3 inventory.
+
+    """
+    return archivist.index_datasets(archivist.process_inventory(inv, url_base), keys)
+
+def reload_index(index, monkeypatch):
+    """Write the file index and load it again, as the next run does (see write_index and load_index).
+
+    Parameters:
+    index: The file index.
+    monkeypatch: The monkeypatch fixture of the test, used to replace Amazon S3.
+
+    """
+    class S3:
+        def download_file(self, Filename, Key):
+            index.to_csv(Filename, index=False)
+    monkeypatch.setattr(archivist, 's3', S3(), raising=False)
+    return archivist.load_index()
+
+@pytest.fixture(autouse=True)
+def archive_root(monkeypatch):
+    monkeypatch.setattr(archivist, 'prefix_root', 'archive', raising=False)
+
+def test_index_datasets_matches_loop():
+    inv = make_inventory()
+    index = create_index(inv)
+    assert index.to_csv(index=False) == index_per_dataset(inv, keys).to_csv(index=False)
+    ## check the cases the test is meant to cover
+    true_dates = dict(zip(index['file_name'], index['file_date_true'].astype(str)))
+    assert true_dates['cases_2021-01-01_10-00.csv'] == '2020-12-31' # multiple hashes on the first date
+    assert true_dates['cases_2021-01-05_08-00.csv'] == '2021-01-04' # multiple hashes after a missing date
+    assert index['file_md5_duplicate'].eq(1).sum() > 0
+
+@pytest.mark.parametrize('until', ['2021-01-01_12-00', '2021-01-03_12-00', '2021-01-05_12-00', '2021-01-06_13-00', '2021-01-08_10-00', '2021-01-09_23-00'])
+def test_update_index_matches_full_index(until, monkeypatch):
+    inv = make_inventory()
+    full = create_index(inv).to_csv(index=False)
+    previous = reload_index(create_index(make_inventory(until=until)), monkeypatch)
+    index = archivist.update_index(previous, inv, url_base, keys)
+    assert index.to_csv(index=False) == full
+    ## updating again without new files gives the same index
+    assert archivist.update_index(reload_index(index, monkeypatch), inv, url_base, keys).to_csv(index=False) == full
+
+@pytest.mark.parametrize('late', [
+    'archive/ab/cases/cases_2021-01-01_10-00.csv', # first file of a dataset
+    'archive/ab/cases/cases_2021-01-05_08-00.csv', # first file after a missing date
+    'archive/ab/cases/cases_2021-01-07_09-00.csv', # only file of its date
+    'archive/ab/schools/schools_2021-01-03_23-00.csv', # only file of its date, before a missing date
+    'archive/ab/schools/schools_2021-01-05_23-00.csv', # superseded file
+    'archive/other/mb/testing/testing_2021-01-06_14-00.csv', # last file of a dataset
+    'archive/other/zz/unlisted/unlisted_2021-01-01_12-00.csv' # dataset not in datasets.json
+])
+def test_update_index_late_file(late, monkeypatch):
+    inv = make_inventory()
+    full = create_index(inv).to_csv(index=False)
+    previous = reload_index(create_index(make_inventory(skip=(late,))), monkeypatch)
+    assert archivist.update_index(previous, inv, url_base, keys).to_csv(index=False) == full
+
+def test_update_index_removed_file(monkeypatch):
+    removed = 'archive/ab/cases/cases_2021-01-04_12-00.csv'
+    inv = make_inventory()
+    full = create_index(inv).to_csv(index=False)
+    previous = reload_index(create_index(make_inventory(extra=(removed,))), monkeypatch)
+    assert archivist.update_index(previous, inv, url_base, keys).to_csv(index=False) == full
@@ -0,0 +1,34 @@
+# test_transforms.py: Tests of the transforms of archivist.py #
+# https://github.com/ccodwg/Covid19CanadaArchive #
+# Maintainer: Jean-Paul R. Soucy #
+
+# import modules
+import os
+import sys
+from zipfile import ZipFile, BadZipFile
+import pytest
+
+## run from anywhere: archivist.py is in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import archivist
+
+def test_unzip_select_member(tmp_path):
+    f_path = str(tmp_path / '13100781.csv')
+    with ZipFile(f_path, 'w') as zip_file:
+        zip_file.writestr('13100781.csv', 'REF_DATE,VALUE\n2020-11-01,1\n')
+        zip_file.writestr('13100781_MetaData.csv', 'metadata\n')
+    dl = {'file': '13100781', 'ext': '.csv', 'encoding': None, 'tmpdir': str(tmp_path)}
+    out = archivist.run_transforms(f_path, ['unzip', 'select_member'], dl)
+    with open(out, 'rb') as local_file:
+        assert local_file.read() == b'REF_DATE,VALUE\n2020-11-01,1\n'
+
+def test_unzip_fails_on_error_page(tmp_path):
+    ## an error page returned with status 200 must not be archived as the data
+    f_path = str(tmp_path / '13100781.csv')
+    with open(f_path, 'w') as local_file:
+        local_file.write('<html><body>Service unavailable</body></html>')
+    dl = {'file': '13100781', 'ext': '.csv', 'encoding': None, 'tmpdir': str(tmp_path)}
+    with pytest.raises(BadZipFile):
+        archivist.run_transforms(f_path, ['unzip', 'select_member'], dl)
+    with pytest.raises(ValueError):
+        archivist.run_transforms(f_path, ['select_member'], dl)